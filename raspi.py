@@ -20,24 +20,79 @@ You should have received a copy of the GNU General Public License
 along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 MA 02110-1301, USA.
+
+raspicheck (psutil, raspiload) is imported after the arguments are parsed,
+matplotlib and numpy only after sampling has ended, so they neither delay
+the start nor add to the memory used while measuring. With --render worker
+charts are drawn by a separate low priority process (raspirender.py
+--queue), its CPU time is not counted in the logged loads. --daemon runs
+no load and no log, it serves the probes as Prometheus metrics
+(raspidaemon.py) until stopped. Every text log ends with '# overhead'
+lines: CPU and memory of the sampler, probe latencies and the loop
+overhead of the load workers; --overhead writes the details as JSON.
 """
+import os
+import sys
 import argparse
 import platform
-from raspicheck import RaspiCheck
-try:
-    from raspianalyse import plot_pdf
-    PDF = True
-except ImportError:
-    PDF = False
+import subprocess
+from importlib.util import find_spec
+from raspikernels import KERNELS
+from raspiprofile import load_profile
 
-__version__ = '0.1.5'
+__version__ = '0.1.18'
 
 PATH = 'data/'
+# charts possible, checked without importing the plotting stack
+PDF = all(find_spec(name) is not None for name in ('matplotlib', 'numpy'))
 
 pversion = platform.python_version().replace('.', '')
 if int(pversion) < 7:
     raise ValueError('requires at least python 3.7')
 
+
+def core_plan(text):
+    '''Return (core, load_plan) of 'core:load,load,...' in equal steps'''
+    try:
+        core, loads = text.split(':')
+        plan = [(1, float(load)) for load in loads.split(',')]
+        return int(core), plan
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'{text!r} is not core:load,load,... e.g. 0:0.1,0.5,1') from None
+
+
+def collector_address(text):
+    '''Return text if it is a valid raspifleet collector address'''
+    from raspifleet import parse_address
+    try:
+        parse_address(text)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err)) from None
+    return text
+
+
+def start_render_worker(chartpath, preview, cores=None):
+    '''Return low priority render worker reading jobs from stdin'''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'raspirender.py')
+    cmd = [sys.executable, script, '--queue', '-o', chartpath,
+           '--preview', str(preview)]
+    if cores:
+        cmd += ['--cores'] + [str(core) for core in cores]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, text=True,
+                            start_new_session=True)
+
+
+def send_job(worker, job, fname):
+    '''Send job ('follow' or 'final') for log fname to render worker'''
+    try:
+        worker.stdin.write(f'{job} {fname}\n')
+        worker.stdin.flush()
+    except OSError:
+        print(f'Render worker ended, no charts for {fname}')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Monitor CPU parameters with changing CPU load')
@@ -46,10 +101,112 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--timeout', type=int,
                         default=600, metavar='',
                         help='runtime of tests - timeout in seconds')
+    parser.add_argument('-f', '--format', default='text',
+                        choices=['text', 'binary', 'both'],
+                        help='log format: text, binary (.bin) or both')
+    parser.add_argument('--flush', type=float, default=10, metavar='',
+                        help='seconds between writing log files to disk')
+    parser.add_argument('-b', '--backend', choices=['psutil', 'sysfs'],
+                        help='read CPU data with psutil/vcgencmd (default) '
+                             'or directly from sysfs (default of --daemon)')
+    parser.add_argument('-r', '--rate', type=float, default=1, metavar='',
+                        help='samples per second (up to 100), faster '
+                             'samples are merged to one per second in logs')
+    parser.add_argument('-c', '--capture', type=float, default=5,
+                        metavar='',
+                        help='seconds logged at full rate before and after '
+                             'throttled state changes, 0 = off')
+    parser.add_argument('-k', '--kernel', default='fpu',
+                        choices=list(KERNELS),
+                        help='workload: scalar fpu, numpy matmul or fft, '
+                             'memory bandwidth, cache misses or file io')
+    parser.add_argument('-p', '--core-plan', type=core_plan,
+                        action='append', metavar='',
+                        help='load of one core in equal steps, e.g. '
+                             '0:0.1,0.5,1 ramps core 0, cores without plan '
+                             'stay idle; repeat for more cores')
+    parser.add_argument('-l', '--profile', metavar='',
+                        help='JSON load profile with steps, ramps, sine and '
+                             'square waves or replayed logs, see '
+                             'raspiprofile.py')
+    parser.add_argument('--pin', action='store_true',
+                        help='pin every load worker to its own core')
+    parser.add_argument('--sampler-core', type=int, metavar='',
+                        help='run the sampler on this core, kept free of '
+                             'load')
+    parser.add_argument('--render', default='worker',
+                        choices=['worker', 'inline', 'off'],
+                        help='draw charts in a low priority worker process '
+                             '(with previews), after the run in this '
+                             'process or not at all')
+    parser.add_argument('--preview', type=float, default=60, metavar='',
+                        help='seconds between chart previews of the render '
+                             'worker')
+    parser.add_argument('--collector', type=collector_address, metavar='',
+                        help='stream samples to a raspifleet collector, '
+                             'tcp://host:port or udp://host:port')
+    parser.add_argument('--node', metavar='',
+                        help='name of this board at the collector, '
+                             'default host name')
+    parser.add_argument('--console', type=float, default=0, metavar='',
+                        help='seconds between sample lines on the '
+                             'console, 0 = every logged sample')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='no sample lines on the console')
+    parser.add_argument('--overhead', action='store_true',
+                        help='print the overhead of sampler and load '
+                             'workers, write it to <log>_overhead.json')
+    parser.add_argument('--daemon', action='store_true',
+                        help='no test run: serve metrics for Prometheus '
+                             'until stopped, see raspidaemon.py')
+    parser.add_argument('--listen', default='127.0.0.1:9755', metavar='',
+                        help='host:port of the metrics endpoint')
+    parser.add_argument('--interval', type=float, default=10, metavar='',
+                        help='seconds between samples of the daemon')
     args = parser.parse_args()
+    from raspicheck import RaspiCheck
+    if args.daemon:
+        from raspidaemon import run_daemon, BACKEND
+        run_daemon(RaspiCheck(backend=args.backend or BACKEND), args.listen,
+                   args.interval)
+        sys.exit()
     setup = ' '.join(args.setup)
     timeout = args.timeout
-    rcheck = RaspiCheck(setup, timeout, path=PATH)
+    rcheck = RaspiCheck(setup, timeout, path=PATH, log_format=args.format,
+                        flush_interval=args.flush,
+                        backend=args.backend or 'psutil',
+                        sleeptime=1 / min(100, max(0.01, args.rate)),
+                        capture=args.capture, kernel=args.kernel,
+                        load_plans=dict(args.core_plan or ()),
+                        pin=args.pin, sampler_core=args.sampler_core,
+                        profile=load_profile(args.profile)
+                        if args.profile else None,
+                        collector=args.collector, node=args.node,
+                        console_interval=None if args.quiet
+                        else args.console, overhead_profile=args.overhead)
+    worker = None
+    if PDF and args.render == 'worker':
+        if rcheck.setup == '':
+            rcheck.setup = input('Enter test setup:')
+        if 'text' in rcheck.log_format:
+            log_fname = rcheck.run_filename(rcheck.setup)
+        else:
+            log_fname = rcheck.binary_filename(rcheck.setup)
+        cores = None
+        if args.sampler_core is not None:
+            # keep the sampler core free, unpinned if it is the only one
+            from raspiload import available_cores
+            cores = [core for core in available_cores()
+                     if core != args.sampler_core]
+        worker = start_render_worker(PATH, args.preview, cores)
+        rcheck.exclude_process(worker.pid)
+        send_job(worker, 'follow', log_fname)
     ffname = rcheck.main()
-    if PDF:
-        plot_pdf(ffname)
+    rcheck.close()
+    if worker is not None:
+        send_job(worker, 'final', ffname)
+        worker.stdin.close()
+        print(f'Charts are drawn by render worker (pid {worker.pid})')
+    elif PDF and args.render == 'inline':
+        from raspianalyse import plot_pdf
+        plot_pdf(ffname, data=(rcheck.setup, ffname, rcheck.samples))
@@ -2,115 +2,242 @@
 """
 Extracting values from log file and preparing chart
 
-
+matplotlib.pyplot is only imported by the plot functions, raspirender
+renders charts of many logs without it. numpy is imported by the functions
+using it, raspiprofile reads text logs to replay without it.
 """
 import os
 import re
-from collections import defaultdict
-import matplotlib.pyplot as plt
-from matplotlib import numpy as np
-
-__version__ = '0.0.5'
-
-colfuncs = {'Core data': [re.compile(r'(?: \d{1,4}\.{1}\d{1} )'),
-                          float,
-                          'seconds',
-                          (0, 1)],
-            'Throttled': [re.compile(r'(?:0|1){19}'),
-                          str,
-                          'Throttled',
-                          (0, 1)],
-            'CPU:': [re.compile(r'(NOK|ok)'),
-                     lambda x: 'NOK' in x,
-                     'CPU not ok',
-                     (0, 1)],
-            'Voltage:': [re.compile(r'(ok|low)'),
-                         lambda x: 'low' in x,
-                         'Voltage not ok',
-                         (0, 1)],
-            'arm freq:': [re.compile(r'(capped|ok)'),
-                          lambda x: 'capped' in x,
-                          'arm freq capped',
-                          (0, 1)],
-            'throttled:': [re.compile(r'(yes|no)'),
-                           lambda x: 'yes' in x,
-                           'CPU throttled',
-                           (0, 1)],
-            'temp limit:': [re.compile(r'(active|inactive)'),
-                            lambda x: 'inactive' in x,
-                            'software temp limit',
-                            (0, 1)],
-            'Volt:': [re.compile(r'(?: \d\.{1}\d{3,4})'),
-                      float,
-                      'voltage',
-                      (0, None)],
-            'Temp': [re.compile(r'(?: \d{2,3}\.{1}\d{1})'),
-                     float,
-                     'temperature',
-                     (0, None)],
-            'Freq': [re.compile(r'(?: \d{1}\.{1}\d{2})'),
-                     float,
-                     'frequency in GHz',
-                     (0, None)],
-            'Load': [re.compile(r'(?:\d{1,3}%)'),
-                     lambda x: float(x[:-1]),
-                     'CPU load in %',
-                     (0, 100)],
-            '[': [re.compile(r'(?:\d{1,3}%)'),
-                  lambda x: float(x[:-1]),
-                  'test',
-                  (0, 100)],
-            }
+import locale
+from functools import partial
+from itertools import islice
+from raspidata import SampleStore, MAX_ROWS, cpu_columns, work_columns
+from raspidata import read_header
 
+__version__ = '0.0.17'
 
-def get_rawdata(fname, path=''):
-    '''Return raw data'''
+CHUNKSIZE = 1 << 20
+BLOCK_ROWS = 50_000
+
+# one entry per ' | ' separated field written by RaspiCheck.raspi_check:
+# (column, label, regex with exactly one group, converter)
+# all fields but the first are optional; placeholders like 'Temp:    - °C'
+# match the field but leave the group empty. Fields without converter are
+# lists of values split into columns <column>0, <column>1, ...
+FLOAT = r'(\d+(?:\.\d*)?)'
+line_fields = [
+    ('time', 'seconds',
+     r'Core data - After\s*' + FLOAT + r' seconds', float),
+    ('cpu_nok', 'CPU not ok',
+     r'CPU:\s*(?:(NOK|ok)|data not available)',
+     {'NOK': 1.0, 'ok': 0.0}.__getitem__),
+    ('undervoltage', 'Voltage not ok',
+     r'Voltage:\s*(low|ok)', {'low': 1.0, 'ok': 0.0}.__getitem__),
+    ('freq_capped', 'arm freq capped',
+     r'arm freq:\s*(capped|ok)',
+     {'capped': 1.0, 'ok': 0.0}.__getitem__),
+    ('throttled', 'CPU throttled',
+     r'throttled:\s*(yes|no)', {'yes': 1.0, 'no': 0.0}.__getitem__),
+    ('soft_temp_limit', 'software temp limit',
+     r'Soft temp limit:\s*(active|inactive)',
+     {'active': 1.0, 'inactive': 0.0}.__getitem__),
+    ('temp', 'temperature',
+     r'Temp:\s*(?:' + FLOAT + r'|-\s*)°C', float),
+    ('volt', 'voltage',
+     r'(?:Volt:\s*' + FLOAT + r'|\s*-\s*)V', float),
+    ('freq', 'frequency in GHz',
+     r'Freq:\s*(?:' + FLOAT + r'|-\s*)GHz', float),
+    ('load', 'CPU load in %',
+     r'Load:\s*' + FLOAT + r'%', float),
+    ('cpu', 'CPU load in %',
+     r'\[([^\]]*)\]', None),
+    ('work', 'work per second',
+     r'Work/s:\s*\[([^\]]*)\]', None),
+    ('late', 'sample delay in ms',
+     r'Late:\s*(?:' + FLOAT + r'|-\s*)ms', float),
+]
+re_line = re.compile(line_fields[0][2]
+                     + ''.join(f'(?:\\s*\\| {regex})?'
+                               for _, _, regex, _ in line_fields[1:]))
+
+
+def decode(raw, encoding='utf8'):
+    '''Return decoded bytes, fall back to locale encoding'''
     try:
-        with open(os.path.join(path, fname), 'r', encoding='utf8') as file:
-            raw = file.read()
+        return raw.decode(encoding)
     except UnicodeDecodeError:
-        with open(os.path.join(path, fname), 'r') as file:
-            raw = file.read()
-    return raw
+        return raw.decode(locale.getpreferredencoding(False), 'replace')
+
+
+def get_rawdata(fname, path=''):
+    '''Return raw data'''
+    with open(os.path.join(path, fname), 'rb') as file:
+        raw = file.read()
+    return decode(raw).replace('\r\n', '\n')
+
+
+def iter_lines(fname, path='', chunksize=CHUNKSIZE):
+    '''Yield lines of log read in chunks of chunksize bytes
+
+    Chunks are cut after the last complete line and decoded one by one,
+    the encoding fallback applies per chunk.
+    '''
+    rest = b''
+    with open(os.path.join(path, fname), 'rb') as file:
+        for chunk in iter(partial(file.read, chunksize), b''):
+            chunk = rest + chunk
+            end = chunk.rfind(b'\n') + 1
+            rest = chunk[end:]
+            if end:
+                yield from decode(chunk[:end]).splitlines()
+    if rest:
+        yield from decode(rest).splitlines()
+
+
+def parse_lines(lines, samples) -> set:
+    '''Parse log lines into samples and return names of columns found
+
+    Every line is matched once by re_line and its values are written
+    straight into the columns, missing values stay NaN. Footer lines
+    starting with '#' (see raspioverhead) are skipped.
+    '''
+    scalars = [i for i, (*_, conv) in enumerate(line_fields) if conv]
+    names = [line_fields[i][0] for i in scalars]
+    convs = [line_fields[i][3] for i in scalars]
+    columns = [samples.add_column(name) for name in names]
+    lists = [(i, name, list()) for i, (name, *_, conv)
+             in enumerate(line_fields) if conv is None]
+    seen = [False] * len(names)
+    match = re_line.match
+    new_row = samples.new_row
+    for line in lines:
+        res = match(line)
+        if res is None:
+            if line and not line.startswith('#'):
+                print(line)
+            continue
+        row = new_row()
+        groups = res.groups()
+        for i, (column, conv, index) in enumerate(zip(columns, convs,
+                                                      scalars)):
+            group = groups[index]
+            if group is not None:
+                column[row] = conv(group)
+                seen[i] = True
+        for index, prefix, list_columns in lists:
+            values = groups[index]
+            if not values:
+                continue
+            values = values.replace('%', '').split(',')
+            while len(list_columns) < len(values):
+                list_columns.append(samples.add_column(
+                    f'{prefix}{len(list_columns)}'))
+            for column, value in zip(list_columns, values):
+                column[row] = float(value)
+    return {name for name, found in zip(names, seen) if found}
 
 
 def read_rawdata(rawdata):
-    ''''''
+    '''Return title, file name and SampleStore parsed from log
+
+    Columns never found in the log are removed.
+    '''
     lines = rawdata.split('\n')
     title_fname = lines.pop(0)
     title = lines.pop(0)
-    res_dict = defaultdict(list)
-    for line in lines:
-        cols = line.split(' | ')
-        for col in cols:
-            keylist = [key for key in colfuncs.keys() if key in col]
-            if keylist:
-                key = keylist[0]
-                # print(key)
-                regex, func, *_ = colfuncs[key]
-                results = re.findall(regex, col)
-                num = 'nores'
-                for i, result in enumerate(results):
-                    try:
-                        num = func(result)
-                    except ValueError:
-                        print('na!!')
-                        num = 'na'
-                    colhead = key.replace(':', '').replace(' ', '_')
-                    colhead = key
-                    if '[' in colhead:
-                        colhead = f'cpu{i}'
-                    res_dict[colhead].append(num)
-
-                    if num == 'naa' or num == 'nores':
-                        print(f'key={key!r:10s} in {col!r} ={num} with '
-                              f'{func} and re {re.findall(regex, col)}')
-                    else:
-                        # print(f'key={key!r:10s} in {col!r} ={num}')
-                        pass
-            else:
-                print(line)
-    return title, title_fname, dict(res_dict)
+    samples = SampleStore(capacity=len(lines))
+    found = parse_lines(lines, samples)
+    for name, *_ in line_fields:
+        if name not in found:
+            samples.remove_column(name)
+    return title, title_fname, samples
+
+
+def iter_samples(fname, path='', block_rows=BLOCK_ROWS):
+    '''Yield (title, title_fname, SampleStore) of up to block_rows rows
+
+    Memory use is bounded by block_rows, independent of the log size.
+    '''
+    lines = iter_lines(fname, path)
+    title_fname = next(lines, '')
+    title = next(lines, '')
+    while True:
+        block = list(islice(lines, block_rows))
+        if not block:
+            return
+        samples = SampleStore(capacity=len(block))
+        parse_lines(block, samples)
+        yield title, title_fname, samples
+
+
+def read_log(fname, path='', max_rows=MAX_ROWS, block_rows=BLOCK_ROWS):
+    '''Return title, file name and SampleStore of at most max_rows rows
+
+    The log is streamed in blocks, whenever more than max_rows rows are
+    parsed the samples are decimated by two (see SampleStore.decimate).
+    '''
+    lines = iter_lines(fname, path)
+    title_fname = next(lines, '')
+    title = next(lines, '')
+    samples = SampleStore()
+    found = set()
+    while True:
+        block = list(islice(lines, block_rows))
+        if not block:
+            break
+        found |= parse_lines(block, samples)
+        while len(samples) > max_rows:
+            samples.decimate()
+    for name, *_ in line_fields:
+        if name not in found:
+            samples.remove_column(name)
+    return title, title_fname, samples
+
+
+def read_binary(fname, path=''):
+    '''Return title, file name and columns of binary log
+
+    The records are mapped with np.memmap, columns are views into the file
+    without any parsing. A partly written last record is ignored.
+    '''
+    import numpy as np
+    ffname = os.path.join(path, fname)
+    with open(ffname, 'rb') as file:
+        header = read_header(file)
+    dtype = np.dtype([(name, header['byteorder'] + 'f8')
+                      for name in header['fields']])
+    rows = (os.path.getsize(ffname) - header['offset']) // dtype.itemsize
+    if rows > 0:
+        records = np.memmap(ffname, dtype=dtype, mode='r',
+                            offset=header['offset'], shape=(rows,))
+    else:
+        records = np.empty(0, dtype=dtype)
+    data = {name: records[name] for name in header['fields']}
+    return header['title'], header['fname'], data
+
+
+def read_any(fname, path='', max_rows=MAX_ROWS):
+    '''Return title, file name and columns of text or binary log
+
+    Text logs are decimated to at most max_rows rows.
+    '''
+    if fname.endswith('.bin'):
+        return read_binary(fname, path)
+    return read_log(fname, path, max_rows)
+
+
+def as_arrays(samples):
+    '''Return numpy arrays sharing memory with SampleStore columns
+
+    samples may also be a dict of numpy arrays (see read_binary).
+    Columns without any value are left out.
+    '''
+    import numpy as np
+    arrays = {name: np.asarray(column) if isinstance(column, np.ndarray)
+              else np.frombuffer(column)
+              for name, column in samples.items()}
+    return {name: values for name, values in arrays.items()
+            if not np.isnan(values).all()}
 
 
 def add_textbox(ax, text):
@@ -124,31 +251,73 @@ def add_textbox(ax, text):
     return ax
 
 
-def plot_pdf(fname, datapath='', chartpath=''):
-    '''Create pdf and show charts'''
+def plot_work(data, title, pdf_fname):
+    '''Create pdf of work per second done by the load workers
+
+    Total work per second over time and against temperature and voltage,
+    None if the log has no work columns.
+    '''
+    names = work_columns(data)
+    if not names:
+        return None
+    import numpy as np
+    import matplotlib.pyplot as plt
+    work = np.nansum([data[name] for name in names], axis=0)
+    fig, axes = plt.subplots(3, 1, figsize=(8.27, 11.69))
+    fig.suptitle(f'{title}\nwork per second', size=16, color='blue',
+                 fontweight='bold')
+    axes[0].plot(data['time'], work, lw=2)
+    axes[0].set_xlabel('seconds')
+    for ax, (name, label) in zip(axes[1:], (('temp', 'Temperature in °C'),
+                                           ('volt', 'CPU Voltage'))):
+        if name in data:
+            ax.scatter(data[name], work, s=4, alpha=0.5)
+        else:
+            add_textbox(ax, f'no data for {label!r}')
+        ax.set_xlabel(label)
+    for ax in axes:
+        ax.set_ylabel('work/s of all workers')
+        ax.grid(True)
+    fig.savefig(pdf_fname)
+    print('Work charts save as pdf to: ', pdf_fname)
+    return fig
+
+
+def plot_pdf(fname, datapath='', chartpath='', data=None):
+    '''Create pdf and show charts
+
+    data = (title, title_fname, SampleStore) as returned by read_rawdata,
+    e.g. from RaspiCheck, the log file is only read if data is None.
+    Binary logs (.bin) are mapped instead of parsed.
+    '''
+    import numpy as np
+    import matplotlib.pyplot as plt
     print('Starting creating charts')
     A4portrait = (8.27, 11.69)
-    rawdata = get_rawdata(fname, datapath)
-    title, title_fname, data = read_rawdata(rawdata)
+    if data is None:
+        data = read_any(fname, datapath)
+    title, title_fname, samples = data
+    data = as_arrays(samples)
     # nrofsupplots = len(data.keys()) - 1
-    xvalues = data['Core data']
-    dummy = [np.nan] * len(xvalues)
+    xvalues = data['time']
+    dummy = np.full(len(xvalues), np.nan)
     fig = plt.figure(figsize=A4portrait,
                      frameon=True)
     fig.suptitle(title, size=16, color='blue', fontweight='bold')
+    setup = title
     gspec = fig.add_gridspec(nrows=5, ncols=2,
                              bottom=0.05, top=0.93,
                              left=0.1, right=0.95,
                              hspace=0.33, wspace=0.25)
     axes = list()
     # draw first data
-    plotdata = [['Temp', '°C', 'Temperature', 'default',
+    plotdata = [['temp', '°C', 'Temperature', 'default',
                  (None, None), (0, 0)],
-                ['Load', 'in %', 'CPU load', 'steps',
+                ['load', 'in %', 'CPU load', 'steps',
                  (0, 105), (1, 0)],
-                ['Freq', 'GHz', 'CPU Frequency', 'steps',
+                ['freq', 'GHz', 'CPU Frequency', 'steps',
                  (None, None), (4, 0)],
-                ['Volt:', 'Voltage', 'CPU Voltage', 'steps',
+                ['volt', 'Voltage', 'CPU Voltage', 'steps',
                  (None, None), (4, 1)]]
     for y, label, title, ds, ylim, pos in plotdata:
         ax = fig.add_subplot(gspec[pos])
@@ -162,10 +331,10 @@ def plot_pdf(fname, datapath='', chartpath=''):
         axes.append(ax)
     # draw digital data
     plotdata = [
-        ['Voltage:', 'Under-voltage detected', (0, 1)],
-        ['arm freq:', 'Arm frequency capped', (1, 1)],
-        ['throttled:', 'CPU throttled', (2, 1)],
-        ['throttled:', 'Soft temperate limit active', (3, 1)], ]
+        ['undervoltage', 'Under-voltage detected', (0, 1)],
+        ['freq_capped', 'Arm frequency capped', (1, 1)],
+        ['throttled', 'CPU throttled', (2, 1)],
+        ['soft_temp_limit', 'Soft temperate limit active', (3, 1)], ]
     for y, title, pos in plotdata:
         ax = fig.add_subplot(gspec[pos])
         ax.fill_between(xvalues, data.get(y, dummy),
@@ -178,19 +347,19 @@ def plot_pdf(fname, datapath='', chartpath=''):
         plt.yticks(visible=False)
     # draw cumulative cpu load
     ax = fig.add_subplot(gspec[2:4, 0])
-    datas = [data[k] for k in data.keys() if k.startswith('cpu')]
+    datas = [data[k] for k in cpu_columns(data)]
     ax.stackplot(xvalues, *datas, alpha=.6)
     ax.set_title('all CPUs load', loc='center')
     ax.set_ylabel('cumulative CPU load in %')
     axes.append(ax)
     # set common parameters
-    xlim = (0, max(xvalues))
+    xlim = (0, np.nanmax(xvalues))
     for ax in axes:
         ax.grid(True)
         ax.set_xlim(xlim)
         ax.set_title(ax.get_title(), fontweight='bold')
         ax.set_ylabel(ax.get_ylabel(), fontweight='bold', fontsize=11)
-    pdf_fname = title_fname.replace('.txt', '.pdf')
+    pdf_fname = os.path.splitext(title_fname)[0] + '.pdf'
     pdf_fname = pdf_fname.replace(datapath, chartpath)
     try:
         os.mkdir(chartpath)
@@ -198,20 +367,16 @@ def plot_pdf(fname, datapath='', chartpath=''):
         pass
     fig.savefig(pdf_fname)
     print('Charts save as pdf to: ', pdf_fname)
+    work_fig = plot_work(data, setup,
+                         os.path.splitext(pdf_fname)[0] + '_work.pdf')
+    if work_fig is not None:
+        plt.close(work_fig)
     return fig
 
 
 if __name__ == '__main__':
+    from raspirender import render_batch
     DATAPATH = 'data/'
     CHARTPATH = 'charts/'
-    fnames = [fname for fname in os.listdir(DATAPATH)
-              if fname.endswith('.txt')]
-    fnames = [fname for fname in fnames if '05-02' in fname]
-    for fname in fnames:
-        try:
-            print(fname)
-            fig = plot_pdf(fname, datapath=DATAPATH, chartpath=CHARTPATH)
-            plt.close()
-        except KeyError:
-            print('Error for :', fname)
-    fig.show()
+    counts = render_batch(DATAPATH, CHARTPATH)
+    print(', '.join(f'{count} {name}' for name, count in counts.items()))
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for raspi-info
+
+requires Python 3.7 or later
+
+Usage:
+    python3 raspibench.py parser -n 1000000
+    python3 raspibench.py sampler -n 200
+    python3 raspibench.py pool -n 10
+    python3 raspibench.py render -n 20 -f png
+    python3 raspibench.py startup
+    python3 raspibench.py fleet -n 100 -r 10 -t 30 --protocol udp
+    python3 raspibench.py daemon -c 20 -t 30
+"""
+import os
+import sys
+import stat
+import shutil
+import argparse
+import subprocess
+import tempfile
+import time
+from functools import partial
+
+__version__ = '0.0.8'
+
+SAMPLE = 'data/sample.txt'
+
+
+def scaled_rawdata(fname=SAMPLE, rows=1_000_000):
+    '''Return sample log with data lines repeated up to rows lines'''
+    with open(fname, 'r', encoding='utf8') as file:
+        header = [file.readline(), file.readline()]
+        lines = [line for line in file.read().split('\n') if line]
+    repeats = rows // len(lines) + 1
+    lines = (lines * repeats)[:rows]
+    return ''.join(header) + '\n'.join(lines)
+
+
+def bench_parser(rows=1_000_000, fname=SAMPLE, repeat=3):
+    '''Print lines/sec of raspianalyse.read_rawdata'''
+    from raspianalyse import read_rawdata
+    rawdata = scaled_rawdata(fname, rows)
+    best = float('inf')
+    for _ in range(repeat):
+        stime = time.perf_counter()
+        _, _, data = read_rawdata(rawdata)
+        best = min(best, time.perf_counter() - stime)
+    print(f'read_rawdata: {rows:,.0f} lines, {len(data.keys())} columns '
+          f'({data.nbytes() / 2**20:.1f} MB) '
+          f'in {best:.2f} sec = {rows / best:,.0f} lines/sec')
+    return rows / best
+
+
+FAKE_VCGENCMD = """#!/bin/sh
+case "$1" in
+    get_throttled) echo throttled=0x50005 ;;
+    measure_volts) echo volt=0.8500V ;;
+    *) echo error=1 ;;
+esac
+"""
+
+
+def fake_sysfs(root, cpus=4):
+    '''Create fake sysfs/procfs tree and vcgencmd below root'''
+    files = {'sys/class/thermal/thermal_zone0/temp': '65231\n',
+             'sys/devices/platform/soc/soc:firmware/get_throttled':
+             '50005\n',
+             'proc/stat': 'cpu  2255 34 2290 22625563 6290 127 456 0 0 0\n'
+             + ''.join(f'cpu{i} 563 8 572 5656390 1572 31 114 0 0 0\n'
+                       for i in range(cpus))
+             + 'intr 114930548 113199788 3 0 5 263 0 4 [...]\n',
+             'bin/vcgencmd': FAKE_VCGENCMD}
+    files.update({f'sys/devices/system/cpu/cpu{i}/cpufreq/scaling_cur_freq':
+                  '1500000\n' for i in range(cpus)})
+    for fname, content in files.items():
+        fname = os.path.join(root, fname)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname, 'w') as file:
+            file.write(content)
+    vcgencmd = os.path.join(root, 'bin/vcgencmd')
+    os.chmod(vcgencmd, os.stat(vcgencmd).st_mode | stat.S_IEXEC)
+    return root
+
+
+def time_ticks(func, ticks):
+    '''Return mean seconds and CPU seconds per call of func'''
+    func()
+    stime, ptime = time.perf_counter(), time.process_time()
+    for _ in range(ticks):
+        func()
+    return ((time.perf_counter() - stime) / ticks,
+            (time.process_time() - ptime) / ticks)
+
+
+def read_serial(probes, direct) -> dict:
+    '''Return {name: result} of probes and direct reads called in turn'''
+    return {name: read() for name, read in {**probes, **direct}.items()}
+
+
+def bench_sampler(ticks=200):
+    '''Print per tick cost of psutil/vcgencmd and sysfs backends
+
+    The psutil backend is timed with its probes called one after the other
+    and run by the ProbeScheduler of RaspiCheck.read_sample.
+    '''
+    from raspicheck import RaspiCheck
+    from raspisysfs import SysfsSampler
+
+    class FakeRaspiCheck(RaspiCheck):
+        '''RaspiCheck calling the fake vcgencmd'''
+        is_raspbian = staticmethod(lambda: True)
+
+    with tempfile.TemporaryDirectory() as root:
+        fake_sysfs(root)
+        os.environ['PATH'] = os.path.join(root, 'bin') + os.pathsep \
+            + os.environ['PATH']
+        rcheck = FakeRaspiCheck()
+        batched = SysfsSampler(root=root, vcgencmd=True)
+        sysfs = SysfsSampler(root=root, vcgencmd=False)
+        try:
+            samplers = [('psutil + vcgencmd serial', partial(
+                            read_serial, rcheck.probe_scheduler().probes,
+                            rcheck.direct_reads)),
+                        ('psutil + vcgencmd scheduled', rcheck.read_sample),
+                        ('sysfs + batched vcgencmd', batched.read_sample),
+                        ('sysfs only', sysfs.read_sample)]
+            print(f'{"backend":28s} {"ms/tick":>9s} {"CPU ms/tick":>12s}')
+            for name, func in samplers:
+                wall, cpu = time_ticks(func, ticks)
+                print(f'{name:28s} {wall * 1000:9.3f} {cpu * 1000:12.3f}')
+            print(f'sample: {sysfs.read_sample()}')
+        finally:
+            rcheck.close_sampler()
+            batched.close()
+            sysfs.close()
+
+
+def bench_pool(runs=10, timeout=0.1):
+    '''Print start cost per run of a new LoadPool and of a reused one'''
+    import contextlib
+    import io
+    from raspiload import LoadPool, load_cpus
+    plan = [(1, 0.5)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        stime = time.perf_counter()
+        for _ in range(runs):
+            load_cpus(timeout, plan)
+        new = (time.perf_counter() - stime) / runs
+        with LoadPool() as pool:
+            stime = time.perf_counter()
+            for _ in range(runs):
+                load_cpus(timeout, plan, pool=pool)
+            reused = (time.perf_counter() - stime) / runs
+    for name, seconds in (('new pool per run', new),
+                          ('persistent LoadPool', reused)):
+        print(f'{name:20s} {(seconds - timeout) * 1000:8.1f} ms overhead '
+              f'per {timeout * 1000:.0f} ms run')
+
+
+def bench_render(datapath=None, logs=20, fmt='pdf'):
+    '''Print charts/sec of plot_pdf and of a reused ChartRenderer
+
+    Both write PDF into a temporary chart directory, fmt adds a run of
+    ChartRenderer in another format. Without datapath the sample log is
+    copied logs times.
+    '''
+    stime = time.perf_counter()
+    from raspirender import ChartRenderer, log_files
+    # the plotting stack is imported by the first ChartRenderer
+    renderer = ChartRenderer()
+    import_time = time.perf_counter() - stime
+    with tempfile.TemporaryDirectory() as tmp:
+        if datapath is None:
+            datapath = os.path.join(tmp, 'data')
+            os.mkdir(datapath)
+            for i in range(logs):
+                shutil.copy(SAMPLE, os.path.join(datapath, f'cr{i:04d}.txt'))
+        chartpath = os.path.join(tmp, 'charts')
+        fnames = log_files(datapath)
+        rates = dict()
+        for chart_fmt in sorted({'pdf', fmt}):
+            stime = time.perf_counter()
+            for fname in fnames:
+                renderer.render(fname, datapath, chartpath, (chart_fmt,))
+            rates[chart_fmt] = len(fnames) / (time.perf_counter() - stime)
+        stime = time.perf_counter()
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        from raspianalyse import plot_pdf, read_any
+        pyplot_time = time.perf_counter() - stime
+        stime = time.perf_counter()
+        for fname in fnames:
+            # plot_pdf names the PDF after the first line of the log,
+            # the log path given here keeps it in chartpath
+            title, _, samples = read_any(fname, datapath)
+            plot_pdf(fname, datapath, chartpath,
+                     data=(title, os.path.join(datapath, fname), samples))
+            plt.close('all')
+        slow = len(fnames) / (time.perf_counter() - stime)
+    print(f'first ChartRenderer {import_time:.2f} sec, '
+          f'matplotlib.pyplot {pyplot_time:.2f} sec')
+    print(f'{len(fnames)} logs: plot_pdf (pdf) {slow:.1f} charts/sec, '
+          + ', '.join(f'ChartRenderer ({name}) {rate:.1f} charts/sec'
+                      for name, rate in rates.items()))
+
+
+STARTUP = '''
+import resource
+import time
+stime = time.perf_counter()
+{imports}
+elapsed = time.perf_counter() - stime
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(elapsed, rss)
+'''
+
+
+def bench_startup(repeat=5):
+    '''Print import time and peak RSS of the raspi.py entry point
+
+    Every case runs in a fresh interpreter, best time of repeat runs.
+    '''
+    cases = [('python only', 'pass'),
+             ('raspi.py -h', 'import raspi'),
+             ('raspi.py sampling', 'import raspi, raspicheck'),
+             ('+ charts', 'import raspi, raspicheck, raspianalyse\n'
+                          'import matplotlib.pyplot')]
+    print(f'{"entry point":20s} {"import ms":>10s} {"max RSS MB":>11s}')
+    for name, imports in cases:
+        code = STARTUP.format(imports=imports)
+        runs = list()
+        for _ in range(repeat):
+            res = subprocess.run([sys.executable, '-c', code], check=True,
+                                 capture_output=True, text=True)
+            elapsed, rss = res.stdout.split()[-2:]
+            runs.append((float(elapsed), int(rss)))
+        elapsed, rss = min(runs)
+        print(f'{name:20s} {elapsed * 1000:10.1f} {rss / 1024:11.1f}')
+
+
+def bench_fleet(nodes=100, rate=10, seconds=10, protocol='tcp', batch=10):
+    '''Print rows/sec and CPU load of a collector fed by simulated nodes
+
+    The collector (raspifleet.py) runs as separate process on localhost,
+    this process simulates all nodes with one FleetSink each, sending
+    rate samples per second.
+    '''
+    import socket
+    import psutil
+    from raspifleet import FleetSink
+    from raspiprobes import ticks
+    from raspidata import COLUMNS, read_header
+    cpus = range(4)
+    names = COLUMNS + tuple(f'cpu{i}' for i in cpus) \
+        + tuple(f'work{i}' for i in cpus)
+    values = dict.fromkeys(names, 0.0)
+    values.update(temp=60.0, volt=0.85, freq=1.5, load=50.0)
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'raspifleet.py')
+    with tempfile.TemporaryDirectory() as tmp:
+        ports = dict(tcp='0', udp='0')
+        ports[protocol] = str(port)
+        collector = subprocess.Popen(
+            [sys.executable, script, '-o', tmp, '--host', '127.0.0.1',
+             '--tcp', ports['tcp'], '--udp', ports['udp']],
+            stdout=subprocess.DEVNULL)
+        time.sleep(1)
+        process = psutil.Process(collector.pid)
+        collector_cpu = sum(process.cpu_times()[:2])
+        sender_cpu = time.process_time()
+        sinks = [FleetSink(f'{protocol}://127.0.0.1:{port}', names,
+                           node=f'node{i:03d}', title='load test',
+                           batch=batch) for i in range(nodes)]
+        sent = late = 0
+        for scheduled, elapsed in ticks(1 / rate, seconds):
+            if time.monotonic() - scheduled > 1 / rate:
+                late += 1
+            values['time'] = elapsed
+            for sink in sinks:
+                sink.write(values)
+            sent += nodes
+        for sink in sinks:
+            sink.close()
+        sender_cpu = time.process_time() - sender_cpu
+        time.sleep(1)
+        collector_cpu = sum(process.cpu_times()[:2]) - collector_cpu
+        collector.terminate()
+        collector.wait()
+        received = 0
+        for fname in os.listdir(tmp):
+            fname = os.path.join(tmp, fname)
+            with open(fname, 'rb') as file:
+                header = read_header(file)
+            received += ((os.path.getsize(fname) - header['offset'])
+                         // (8 * len(header['fields'])))
+    print(f'{nodes} nodes x {rate:g} Hz over {protocol}, {batch} rows per '
+          f'frame, {seconds:g} sec: {sent} rows sent, {received} written, '
+          f'{sent - received} lost, {late} ticks late')
+    print(f'collector {collector_cpu / seconds:.1%} of one core = '
+          f'{received / max(collector_cpu, 1e-9):,.0f} rows per CPU second, '
+          f'simulated nodes {sender_cpu / seconds:.1%}')
+
+
+def bench_daemon(scrapers=10, seconds=10, interval=1.0, backend='psutil'):
+    '''Print scrapes/sec, probe reads and CPU/RSS of raspidaemon.py
+
+    scrapers threads request /metrics back to back, the daemon must still
+    read its probes only once per interval.
+    '''
+    import re
+    import socket
+    import threading
+    import psutil
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'raspidaemon.py')
+    daemon = subprocess.Popen(
+        [sys.executable, script, '--listen', f'127.0.0.1:{port}', '-i',
+         str(interval), '-b', backend], stdout=subprocess.DEVNULL)
+
+    def scrape():
+        with socket.create_connection(('127.0.0.1', port), 5) as sock:
+            sock.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+            return b''.join(iter(lambda: sock.recv(65536), b''))
+
+    try:
+        for _ in range(50):
+            try:
+                first = scrape()
+                break
+            except OSError:
+                time.sleep(0.1)
+        process = psutil.Process(daemon.pid)
+        cpu = sum(process.cpu_times()[:2])
+        scrapes = list()
+        end = time.monotonic() + seconds
+
+        def scraper():
+            count = 0
+            while time.monotonic() < end:
+                scrape()
+                count += 1
+            scrapes.append(count)
+
+        threads = [threading.Thread(target=scraper)
+                   for _ in range(scrapers)]
+        _ = [t.start() for t in threads]
+        _ = [t.join() for t in threads]
+        time.sleep(max(0.0, end - time.monotonic()))
+        cpu = sum(process.cpu_times()[:2]) - cpu
+        rss = process.memory_info().rss
+        last = scrape()
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    def samples(page):
+        return int(re.search(rb'raspi_daemon_samples_total (\d+)',
+                             page).group(1))
+
+    print(f'{scrapers} scrapers, {seconds:g} sec: {sum(scrapes)} scrapes '
+          f'= {sum(scrapes) / seconds:,.0f}/sec, '
+          f'{samples(last) - samples(first)} probe reads '
+          f'(interval {interval:g} sec)')
+    print(f'daemon {cpu / seconds:.1%} of one core, '
+          f'RSS {rss / 2**20:.1f} MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark raspi-info')
+    commands = parser.add_subparsers(dest='command', required=True)
+    cmd = commands.add_parser('parser', help='throughput of log parser')
+    cmd.add_argument('-n', '--rows', type=int, default=1_000_000,
+                     metavar='', help='number of log lines')
+    cmd.add_argument('-f', '--fname', default=SAMPLE, metavar='',
+                     help='sample log scaled up to rows lines')
+    cmd = commands.add_parser('sampler',
+                              help='per tick cost of sampler backends')
+    cmd.add_argument('-n', '--ticks', type=int, default=200, metavar='',
+                     help='number of ticks')
+    cmd = commands.add_parser('pool', help='start cost of load workers')
+    cmd.add_argument('-n', '--runs', type=int, default=10, metavar='',
+                     help='number of back to back runs')
+    cmd = commands.add_parser('render', help='charts per second')
+    cmd.add_argument('-d', '--datapath', metavar='',
+                     help='directory of cr*.txt/.bin logs, default copies '
+                          'of the sample log')
+    cmd.add_argument('-n', '--logs', type=int, default=20, metavar='',
+                     help='number of sample log copies')
+    cmd.add_argument('-f', '--format', default='pdf',
+                     choices=['pdf', 'png', 'svg'],
+                     help='ChartRenderer format in addition to pdf')
+    cmd = commands.add_parser('startup',
+                              help='import time and RSS of raspi.py')
+    cmd.add_argument('-n', '--repeat', type=int, default=5, metavar='',
+                     help='fresh interpreters per case')
+    cmd = commands.add_parser('fleet',
+                              help='load test of the raspifleet collector')
+    cmd.add_argument('-n', '--nodes', type=int, default=100, metavar='',
+                     help='simulated nodes')
+    cmd.add_argument('-r', '--rate', type=float, default=10, metavar='',
+                     help='samples per second of every node')
+    cmd.add_argument('-t', '--seconds', type=float, default=10,
+                     metavar='', help='duration of the test')
+    cmd.add_argument('-b', '--batch', type=int, default=10, metavar='',
+                     help='rows per frame')
+    cmd.add_argument('--protocol', default='tcp', choices=['tcp', 'udp'],
+                     help='transport of the frames')
+    cmd = commands.add_parser('daemon',
+                              help='scrape cost of the metrics daemon')
+    cmd.add_argument('-c', '--scrapers', type=int, default=10, metavar='',
+                     help='concurrent scrapers')
+    cmd.add_argument('-t', '--seconds', type=float, default=10,
+                     metavar='', help='duration of the test')
+    cmd.add_argument('-i', '--interval', type=float, default=1,
+                     metavar='', help='sample interval of the daemon')
+    cmd.add_argument('-b', '--backend', default='psutil',
+                     choices=['psutil', 'sysfs'], help='probes of the daemon')
+    args = parser.parse_args()
+    if args.command == 'parser':
+        bench_parser(args.rows, args.fname)
+    elif args.command == 'sampler':
+        bench_sampler(args.ticks)
+    elif args.command == 'pool':
+        bench_pool(args.runs)
+    elif args.command == 'render':
+        bench_render(args.datapath, args.logs, args.format)
+    elif args.command == 'startup':
+        bench_startup(args.repeat)
+    elif args.command == 'fleet':
+        bench_fleet(args.nodes, args.rate, args.seconds, args.protocol,
+                    args.batch)
+    elif args.command == 'daemon':
+        bench_daemon(args.scrapers, args.seconds, args.interval,
+                     args.backend)
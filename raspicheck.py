@@ -25,17 +25,25 @@ MA 02110-1301, USA.
 
 """
 import subprocess
-import string
-import unicodedata
+import multiprocessing
 from threading import Thread
-from queue import Queue
 from functools import lru_cache
 import psutil
 from psutil import time
 # from subprocess import SubprocessError
-from raspiload import load_cpus
+from raspiload import LoadPool, load_cpus, pin_to
+from raspisysfs import SysfsSampler
+from raspiprobes import ProbeScheduler, ticks
+from raspidata import SampleStore, RingBuffer, TextWriter, BinaryWriter
+from raspidata import COLUMNS, FLUSH_INTERVAL, MAX_ROWS
+from raspidata import cpu_columns, work_columns, clean_name, Sample
+from raspioverhead import Overhead
 
-__version__ = '0.1.13'
+__version__ = '0.1.30'
+
+
+# under-voltage, arm freq capped, throttled, soft temperature limit active
+TRIGGER_BITS = 0b1111
 
 
 class RaspiCheck():
@@ -51,25 +59,86 @@ class RaspiCheck():
                              max_cpus=None,
                              delay=10)
 
-    def __init__(self, setup='', timeout=600, delay=0, path='data/'):
+    # log formats written by main
+    log_formats = dict(text=('text',),
+                       binary=('binary',),
+                       both=('text', 'binary'))
+
+    def __init__(self, setup='', timeout=600, delay=0, path='data/',
+                 log_format='text', flush_interval=FLUSH_INTERVAL,
+                 max_samples=MAX_ROWS, backend='psutil', sleeptime=1,
+                 write_interval=1, capture=5, kernel='fpu',
+                 load_plans=None, pin=False, sampler_core=None,
+                 profile=None, collector=None, node=None,
+                 console_interval=0.0, overhead_profile=False):
         '''Initialise Raspi'''
         self.path = path
+        self.log_format = self.log_formats[log_format]
         self.load_cpus = load_cpus
         self.setup = setup
         self.timeout = float(timeout)
         self.delay = float(delay)
-        self.tcounter = self.time_counter()
-        self.queue = Queue()
-
-    @staticmethod
-    def time_counter():
-        '''return time since start'''
-        resp = 'reset'
-        while resp != 'stop':
-            if resp == 'reset':
-                start_time = time.time()
-            el_time = time.time() - start_time
-            resp = yield round(el_time, 2)
+        self.flush_interval = float(flush_interval)
+        # samples kept for charts, decimated beyond max_samples rows
+        self.max_samples = max_samples
+        self.samples = SampleStore()
+        # 'psutil': psutil and vcgencmd per probe, 'sysfs': SysfsSampler
+        self.backend = backend
+        self.sampler = None
+        self.scheduler = None
+        # part of a tick after the scheduled time probes must answer in
+        self.probe_deadline = 0.5
+        # seconds between samples and between samples written to logs
+        self.sleeptime = float(sleeptime)
+        self.write_interval = max(self.sleeptime, float(write_interval))
+        self.time_decimals = 1 if self.sleeptime >= 0.1 else 2
+        # seconds written at full rate before and after throttled changes
+        self.capture = float(capture)
+        # workload of raspiload, see raspikernels.KERNELS
+        self.kernel = kernel
+        # work done by each load worker, written by raspiload.load_cpus
+        self.work_counters = multiprocessing.Array('d', psutil.cpu_count(),
+                                                   lock=False)
+        self.last_work = None
+        # {core: load_plan} of raspiload, None = same plan on all cores
+        self.load_plans = load_plans
+        # pin load workers to their cores, keep sampler_core free of load
+        self.pin = pin
+        self.sampler_core = sampler_core
+        # raspiprofile.Profile or {core: Profile} replacing the load plan
+        if isinstance(profile, dict):
+            self.load_plans, profile = profile, None
+        self.profile = profile
+        # load workers kept alive between runs of main, see close
+        self.load_pool = None
+        # processes whose CPU time is not counted in the loads, e.g. the
+        # render worker, see exclude_process
+        self.excluded = list()
+        self.last_excluded = None
+        # 'tcp://host:port' or 'udp://host:port' of a raspifleet
+        # collector the written samples are streamed to, node = name of
+        # this board there, default host name
+        self.collector = collector
+        self.node = node
+        # seconds between sample lines printed, 0 = every written sample,
+        # None = none; lines are formatted only if printed or logged
+        self.console_interval = console_interval
+        self.last_console = None
+        # probe latency, tick jitter, CPU and RSS of the last run, see
+        # raspioverhead; overhead_profile = also write it as JSON
+        self.overhead = Overhead()
+        self.overhead_profile = overhead_profile
+        # loop overhead of the load workers in the last run of main
+        self.load_overheads = list()
+        # direct reads of the backend timed by overhead, see
+        # probe_scheduler
+        self.direct_reads = None
+        # text log of the last run
+        self.text_fname = None
+        # log name of the next or running run, dated when first asked
+        # for, and of the last finished run, see run_filename
+        self.run_fname = None
+        self.last_fname = None
 
     @staticmethod
     @lru_cache(maxsize=1)
@@ -88,21 +157,35 @@ class RaspiCheck():
                     return True
         return False
 
-    @lru_cache(maxsize=1)
     def valid_filename(self, txt='', path=None):
         '''Return valid filename with date'''
         if path is None:
             path = self.path
-        valid_chars = "-_. %s%s" % (string.ascii_letters, string.digits)
-        cleaned_txt = unicodedata.normalize('NFKD', txt).encode('ASCII',
-                                                                'ignore')
-        cleaned_txt = cleaned_txt.decode('utf8').replace(' ', '_')
-        cleaned_txt = ''.join(c for c in cleaned_txt if c in valid_chars)
-        fname = f'rsp_{psutil.time.time():}'
+        cleaned_txt = clean_name(txt)
         dtime = psutil.time.strftime('%Y-%m-%d-%H%M%S')
         fname = f"{path}cr{dtime}_{cleaned_txt}.txt"
         return fname
 
+    def run_filename(self, txt=''):
+        '''Return text log name of the next or running run
+
+        Dated once per run, so names asked for before the run (e.g. for
+        the render worker) match the logs written; raspi_check starts a
+        new name for the following run.
+        '''
+        if self.run_fname is None:
+            self.run_fname = self.valid_filename(txt)
+        return self.run_fname
+
+    @staticmethod
+    def binary_name(fname):
+        '''Return binary log name of text log fname'''
+        return fname[:-len('.txt')] + '.bin'
+
+    def binary_filename(self, txt=''):
+        '''Return binary log name of the next or running run'''
+        return self.binary_name(self.run_filename(txt))
+
     def run_vcgencmd(self, cmd):
         '''Return answer from subprocess'''
         fullcmd = f'vcgencmd {cmd}'
@@ -112,77 +195,347 @@ class RaspiCheck():
                                  timeout=0.3, check=True, shell=True)
             res_txt = res.stdout.decode()
             assert 'error' not in res_txt
-        except (AssertionError, subprocess.CalledProcessError):
+        except (AssertionError, subprocess.CalledProcessError,
+                subprocess.TimeoutExpired):
             okay, res_data = False, ' - '
         else:
             okay, (_, res_data) = True, res_txt.split('=')
         return okay, res_data.strip()
 
-    def get_throttled(self) -> str:
-        '''Get throttled digit if available'''
+    def read_throttled(self):
+        '''Return throttled bits as int or None if not available'''
         okay, res = self.run_vcgencmd('get_throttled')
         if okay:
-            states = list()
-            throttled = int(res, 0)
-            if throttled & 0b111:
-                states = ['CPU: NOK']
-            else:
-                states = ['CPU:  ok']
-            if throttled & 0b1:
-                states.append('Voltage: low')
-            else:
-                states.append('Voltage:  ok')
-            if throttled & 0b10:
-                states.append('arm freq: capped')
-            else:
-                states.append('arm freq:  ok   ')
-            if throttled & 0b100:
-                states.append('throttled: yes')
-            else:
-                states.append('throttled:  no')
-            return states
-        return [f'CPU: data not available']
+            return int(res, 0)
+        return None
 
     @staticmethod
-    def get_temperature() -> str:
-        '''Get temperature'''
-        res = getattr(psutil, 'sensors_temperatures', '   - °C')
+    def format_throttled(throttled) -> list:
+        '''Return states of throttled bits as text'''
+        if throttled is None:
+            return [f'CPU: data not available']
+        states = list()
+        if throttled & 0b111:
+            states = ['CPU: NOK']
+        else:
+            states = ['CPU:  ok']
+        if throttled & 0b1:
+            states.append('Voltage: low')
+        else:
+            states.append('Voltage:  ok')
+        if throttled & 0b10:
+            states.append('arm freq: capped')
+        else:
+            states.append('arm freq:  ok   ')
+        if throttled & 0b100:
+            states.append('throttled: yes')
+        else:
+            states.append('throttled:  no')
+        if throttled & 0b1000:
+            states.append('Soft temp limit: active')
+        else:
+            states.append('Soft temp limit: inactive')
+        return states
+
+    def get_throttled(self) -> str:
+        '''Get throttled digit if available'''
+        return self.format_throttled(self.read_throttled())
+
+    @staticmethod
+    def read_temperature():
+        '''Return temperature in °C or None if not available'''
+        res = getattr(psutil, 'sensors_temperatures', None)
         try:
-            result = res()['cpu_thermal'][0]
-            res = f'Temp: {result.current:5.1f}°C'
-        except TypeError:
-            res = 'Temp:    - °C'
-        return res
+            return res()['cpu_thermal'][0].current
+        except (TypeError, KeyError):
+            return None
 
-    def get_voltage(self) -> str:
-        '''Get CPU voltage'''
+    @staticmethod
+    def format_temperature(temp) -> str:
+        '''Return temperature as text'''
+        if temp is None:
+            return 'Temp:    - °C'
+        return f'Temp: {temp:5.1f}°C'
+
+    def get_temperature(self) -> str:
+        '''Get temperature'''
+        return self.format_temperature(self.read_temperature())
+
+    def read_voltage(self):
+        '''Return CPU voltage in V or None if not available'''
         okay, res = self.run_vcgencmd('measure_volts core')
         if okay:
-            voltage = float(res[:-1])
-            return f'Volt: {voltage:>6.4f}V'
-        return f'    - V'
+            return float(res[:-1])
+        return None
+
+    @staticmethod
+    def format_voltage(voltage) -> str:
+        '''Return CPU voltage as text'''
+        if voltage is None:
+            return f'    - V'
+        return f'Volt: {voltage:>6.4f}V'
+
+    def get_voltage(self) -> str:
+        '''Get CPU voltage'''
+        return self.format_voltage(self.read_voltage())
+
+    @staticmethod
+    def read_frequency() -> float:
+        '''Return CPU frequency in GHz'''
+        return psutil.cpu_freq().current / 1000
 
     @staticmethod
-    def get_frequency() -> str:
+    def format_frequency(freq) -> str:
+        '''Return CPU frequency as text'''
+        if freq is None:
+            return 'Freq:  - GHz'
+        return f'Freq:{freq:5,.2f}GHz'
+
+    def get_frequency(self) -> str:
         '''Get CPU frequency'''
-        return f'Freq:{psutil.cpu_freq().current / 1000:5,.2f}GHz'
+        return self.format_frequency(self.read_frequency())
 
     @staticmethod
-    def get_cpu_avg_load() -> str:
+    def read_cpu_avg_load() -> float:
+        '''Return average CPU load in %'''
+        return psutil.cpu_percent(percpu=False)
+
+    @staticmethod
+    def format_cpu_avg_load(load) -> str:
+        '''Return average CPU load as text'''
+        return f'Load:{load:4.0f}% '
+
+    def get_cpu_avg_load(self) -> str:
         '''Get average CPU load'''
-        return f'Load:{psutil.cpu_percent(percpu=False):4.0f}% '
+        return self.format_cpu_avg_load(self.read_cpu_avg_load())
 
     @staticmethod
-    def get_cpu_all_load() -> str:
+    def read_cpu_all_load() -> list:
+        '''Return load of all CPUs in %'''
+        loads = psutil.cpu_percent(percpu=True)
+        if not loads:
+            loads = [psutil.cpu_percent(percpu=False)] * psutil.cpu_count()
+        return loads
+
+    @staticmethod
+    def format_cpu_all_load(loads) -> str:
+        '''Return load of all CPUs as text'''
+        return f'[{",".join(f"{f:3.0f}%" for f in loads)}]'
+
+    def get_cpu_all_load(self) -> str:
         '''Get load of all CPUs'''
-        freqs = psutil.cpu_percent(percpu=True)
-        if freqs:
-            freqs = [f'{f:3.0f}%' for f in freqs]
-        else:
-            freq = f'{psutil.cpu_percent(percpu=False):3.0f}%'
-            freqs = [freq, ] * psutil.cpu_count()
-        freqs = f'[{",".join(freqs)}]'
-        return freqs
+        return self.format_cpu_all_load(self.read_cpu_all_load())
+
+    def probe_scheduler(self):
+        '''Return ProbeScheduler running the slow probes of the backend
+
+        All probes and direct reads record their latency in overhead.
+        '''
+        if self.scheduler is None:
+            if self.backend == 'sysfs':
+                self.sampler = SysfsSampler(vcgencmd=self.is_raspbian())
+                probes = dict(vc=self.sampler.read_vc)
+                direct = dict(loads=self.sampler.read_cpu_loads,
+                              temp=self.sampler.read_temperature,
+                              freq=self.sampler.read_frequency)
+            else:
+                probes = dict(throttled=self.read_throttled,
+                              temp=self.read_temperature,
+                              voltage=self.read_voltage,
+                              freq=self.read_frequency)
+                direct = dict(load=self.read_cpu_avg_load,
+                              loads=self.read_cpu_all_load)
+            timed = self.overhead.timed
+            self.scheduler = ProbeScheduler(
+                {name: timed(f'probe {name}', probe)
+                 for name, probe in probes.items()})
+            self.direct_reads = {name: timed(f'read {name}', read)
+                                 for name, read in direct.items()}
+        return self.scheduler
+
+    def read_sample(self, deadline=None):
+        '''Return throttled, temp, voltage, freq, load, loads of one tick
+
+        Slow probes run concurrently until deadline (time.monotonic),
+        probes missing the deadline return None. CPU loads are read
+        directly as they are cheap and must be taken at the tick.
+        '''
+        if deadline is None:
+            deadline = time.monotonic() + self.probe_deadline
+        results = self.probe_scheduler().run(deadline)
+        direct = self.direct_reads
+        if self.backend == 'sysfs':
+            throttled, voltage = results['vc'] or (None, None)
+            load, loads = direct['loads']()
+            return (throttled, direct['temp'](), voltage, direct['freq'](),
+                    load, loads)
+        return (results['throttled'], results['temp'], results['voltage'],
+                results['freq'], direct['load'](), direct['loads']())
+
+    def read_work(self, seconds) -> list:
+        '''Return work per second of each load worker since last call
+
+        Empty list as long as no worker has done any work.
+        '''
+        work = list(self.work_counters)
+        last = self.last_work
+        self.last_work = seconds, work
+        if not any(work):
+            return []
+        if last is None or seconds <= last[0]:
+            return [0.0] * len(work)
+        elapsed = seconds - last[0]
+        return [(done - before) / elapsed
+                for done, before in zip(work, last[1])]
+
+    def exclude_process(self, pid):
+        '''Do not count CPU time of process pid in the logged loads'''
+        self.excluded.append(psutil.Process(pid))
+
+    def subtract_excluded(self, seconds, load, loads):
+        '''Return load and loads without CPU time of excluded processes
+
+        The CPU time since the last call is taken from the cores the
+        process may run on, evenly if it may run on several.
+        '''
+        if not self.excluded:
+            return load, loads
+        usage = dict()
+        for process in self.excluded:
+            try:
+                times = process.cpu_times()
+                cores = process.cpu_affinity()
+            except (psutil.Error, AttributeError):
+                continue
+            usage[process.pid] = times.user + times.system, cores
+        last = self.last_excluded
+        self.last_excluded = seconds, usage
+        if last is None or seconds <= last[0] or load is None:
+            return load, loads
+        elapsed = seconds - last[0]
+        loads = list(loads)
+        for pid, (cpu, cores) in usage.items():
+            if pid not in last[1]:
+                continue
+            # % of one core
+            busy = (cpu - last[1][pid][0]) / elapsed * 100
+            cores = [core for core in cores if core < len(loads)] \
+                or range(len(loads))
+            for core in cores:
+                loads[core] = max(0.0, loads[core] - busy / len(cores))
+            load = max(0.0, load - busy / max(1, len(loads)))
+        return load, loads
+
+    def close_sampler(self):
+        '''Stop ProbeScheduler and close files of SysfsSampler'''
+        if self.scheduler is not None:
+            self.scheduler.close()
+            self.scheduler = None
+        if self.sampler is not None:
+            self.sampler.close()
+            self.sampler = None
+
+    @staticmethod
+    def sample_values(seconds, throttled, temp, voltage,
+                      freq, load, loads, late=None, works=()) -> dict:
+        '''Return sample as dict of SampleStore columns'''
+        return Sample(seconds, throttled, temp, voltage, freq, load, loads,
+                      late, works).values()
+
+    @staticmethod
+    def format_late(late) -> str:
+        '''Return delay of sample after scheduled time as text'''
+        if late is None:
+            return 'Late:  - ms'
+        return f'Late:{late:5.0f}ms'
+
+    @staticmethod
+    def format_work(works) -> str:
+        '''Return work per second of load workers as text, None = nan'''
+        return 'Work/s: [' + ', '.join(
+            'nan' if w is None else f'{w:.3g}' for w in works) + ']'
+
+    @staticmethod
+    def throttled_bits(values):
+        '''Return throttled bits of sample values or None'''
+        flags = [values.get(name) for name in
+                 ('undervoltage', 'freq_capped', 'throttled',
+                  'soft_temp_limit')]
+        if all(flag is None for flag in flags):
+            return None
+        return sum(1 << i for i, flag in enumerate(flags) if flag)
+
+    def format_line(self, values) -> str:
+        '''Return sample values as line of text log'''
+        loads = [values[name] for name in cpu_columns(values)]
+        line_list = [f'Core data - After '
+                     f'{values["time"]:5.{self.time_decimals}f} seconds']
+        line_list.extend(self.format_throttled(self.throttled_bits(values)))
+        line_list.append(self.format_temperature(values.get('temp')))
+        line_list.append(self.format_voltage(values.get('volt')))
+        line_list.append(self.format_frequency(values.get('freq')))
+        line_list.append(self.format_cpu_avg_load(values.get('load')))
+        line_list.append(self.format_cpu_all_load(loads))
+        works = [values[name] for name in work_columns(values)]
+        # samples written late may be from before the workers started
+        if any(work is not None for work in works):
+            line_list.append(self.format_work(works))
+        line_list.append(self.format_late(values.get('late')))
+        return ' | '.join(line_list)
+
+    def open_writers(self, setup) -> dict:
+        '''Return writers {'text': ..., 'binary': ..., 'fleet': ...}'''
+        writers = dict()
+        fname = self.run_filename(setup)
+        cpus = range(psutil.cpu_count())
+        names = COLUMNS + tuple(f'cpu{i}' for i in cpus) \
+            + tuple(f'work{i}' for i in cpus)
+        if 'text' in self.log_format:
+            self.text_fname = fname
+            writers['text'] = TextWriter(
+                fname, header=(fname, setup),
+                flush_interval=self.flush_interval)
+        if 'binary' in self.log_format:
+            writers['binary'] = BinaryWriter(
+                self.binary_name(fname), names, title=setup,
+                text_fname=fname, flush_interval=self.flush_interval)
+        if self.collector:
+            from raspifleet import FleetSink
+            writers['fleet'] = FleetSink(self.collector, names,
+                                         node=self.node, title=setup)
+        return writers
+
+    def write_sample(self, writers, values, stepper=1):
+        '''Write sample to logs, keep it for charts
+
+        Text log, console and charts get every stepper-th sample and all
+        samples with CPU not ok.
+        '''
+        for name in ('binary', 'fleet'):
+            if name in writers:
+                writers[name].write(values)
+        self.counter += 1
+        if values['cpu_nok'] or (self.counter % stepper == 0):
+            console = self.console_due(values['time'])
+            if console or 'text' in writers:
+                line = self.format_line(values)
+                if console:
+                    print(f'{self.counter:4.0f}. {line}')
+                if 'text' in writers:
+                    writers['text'].write(line)
+            self.samples.append(values)
+            if len(self.samples) > self.max_samples:
+                self.samples.decimate()
+
+    def console_due(self, seconds) -> bool:
+        '''Return True if a sample line is printed at seconds'''
+        if self.console_interval is None:
+            return False
+        if (self.last_console is not None
+                and seconds - self.last_console < self.console_interval):
+            return False
+        self.last_console = seconds
+        return True
 
     def raspi_check(self, setup='', timeout=None,
                     sleeptime=1, log_all=False):
@@ -191,30 +544,88 @@ class RaspiCheck():
             setup = self.setup
         if timeout is None:
             timeout = self.timeout
-        lines = [self.valid_filename(setup), setup]
-        next(self.tcounter)
-        self.tcounter.send('reset')
-        counter = 0
+        if self.sampler_core is not None:
+            # probe threads started later inherit the affinity
+            pin_to({self.sampler_core})
+        self.overhead = Overhead()
+        self.overhead.start()
+        self.text_fname = None
+        writers = self.open_writers(setup)
+        # the next run gets a new name
+        self.last_fname, self.run_fname = self.run_fname, None
+        self.counter = 0
+        # the charts show this run only
+        self.samples = SampleStore()
+        self.last_console = None
+        self.last_work = None
+        self.last_excluded = None
         stepper = min(10, max(1, round(timeout / 10, 0)))
         if log_all:
             stepper = 1
-        while next(self.tcounter) < timeout:
-            line_list = [f'Core data - After {next(self.tcounter):5.1f}'
-                         f' seconds']
-            line_list.extend(self.get_throttled())
-            line_list.append(self.get_temperature())
-            line_list.append(self.get_voltage())
-            line_list.append(self.get_frequency())
-            line_list.append(self.get_cpu_avg_load())
-            line_list.append(self.get_cpu_all_load())
-            line = ' | '.join(line_list)
-            counter += 1
-            if 'NOK' in line or (counter % stepper == 0):
-                print(f'{counter:4.0f}. {line}')
-                lines.append(line)
-            time.sleep(sleeptime - time.time() % sleeptime)
-        filetxt = '\n'.join(lines)
-        self.queue.put(filetxt)
+        # samples per written sample, faster samples are merged
+        window = max(1, round(self.write_interval / sleeptime))
+        # samples written unmerged before a change of throttled bits, the
+        # newest pre_rows samples are held back until they are merged
+        pre_rows = round(self.capture / sleeptime)
+        ring = RingBuffer(capacity=window + pre_rows)
+        deadline = self.probe_deadline * min(1, sleeptime)
+        pending = 0
+        last_bits = None
+        capture_until = -1
+        jitter = self.overhead.histogram('tick jitter')
+        work = self.overhead.histogram('tick work')
+        try:
+            for scheduled, seconds in ticks(sleeptime, timeout):
+                begin = time.monotonic()
+                jitter.add(begin - scheduled)
+                (throttled, temp, voltage,
+                 freq, load, loads) = self.read_sample(scheduled + deadline)
+                # ms after the scheduled time all values were available
+                late = (time.monotonic() - scheduled) * 1000
+                load, loads = self.subtract_excluded(seconds, load, loads)
+                ring.append_sample(Sample(seconds, throttled, temp, voltage,
+                                          freq, load, loads, late,
+                                          self.read_work(seconds)))
+                pending += 1
+                if throttled is not None:
+                    bits = throttled & TRIGGER_BITS
+                    if self.capture and last_bits not in (None, bits):
+                        capture_until = seconds + self.capture
+                        if pending > pre_rows:
+                            self.write_sample(
+                                writers, ring.aggregate(pending - pre_rows,
+                                                        skip=pre_rows),
+                                stepper)
+                            pending = pre_rows
+                    last_bits = bits
+                if seconds <= capture_until:
+                    for row in ring.last_rows(pending):
+                        self.write_sample(writers, ring.row_values(row), 1)
+                    pending = 0
+                elif pending >= window + pre_rows:
+                    # oldest window, the pre_rows after it stay unwritten
+                    self.write_sample(
+                        writers, ring.aggregate(window, skip=pending - window),
+                        stepper)
+                    pending -= window
+                work.add(time.monotonic() - begin)
+        finally:
+            # samples not written yet, merged per window as in the loop
+            while pending:
+                rows = min(window, pending)
+                self.write_sample(
+                    writers, ring.aggregate(rows, skip=pending - rows),
+                    stepper)
+                pending -= rows
+            # the vcgencmd shell is reaped here, its CPU time counts
+            # in the subprocesses of the overhead
+            self.close_sampler()
+            self.overhead.stop()
+            if 'text' in writers:
+                for line in self.overhead.summary_lines():
+                    writers['text'].write(line)
+            for writer in writers.values():
+                writer.close()
 
     def main(self):
         '''Start CPU check'''
@@ -223,19 +634,29 @@ class RaspiCheck():
         raspicheck_context = self.raspicheck_context.copy()
         raspicheck_context['setup'] = self.setup
         raspicheck_context['timeout'] = self.timeout
+        raspicheck_context['sleeptime'] = self.sleeptime
         raspicheck_context['log_all'] = False
         # start raspiload with 50% load after 1/3 of total timeout
         raspiload_context = self.raspiload_context.copy()
-        raspiload_context['load_plan'] = [(1, 0.1), (1, 0.3),
-                                          (1, 0.6), (1, 1.0)]
         raspiload_context['timeout'] = self.timeout
         raspiload_context['delay'] = self.delay
+        raspiload_context['kernel'] = self.kernel
+        raspiload_context['counters'] = self.work_counters
+        raspiload_context['load_plans'] = self.load_plans
+        raspiload_context['pin'] = self.pin
+        raspiload_context['reserved'] = self.sampler_core
+        raspiload_context['profile'] = self.profile
+        if self.load_pool is None:
+            self.load_pool = LoadPool(counters=self.work_counters,
+                                      reserved=self.sampler_core)
+        raspiload_context['pool'] = self.load_pool
+        self.load_overheads = list()
 
         start_time = time.time()
         runtxt = f'{self.setup!r} running for ' \
                  f'{raspicheck_context["timeout"]/60:4.1f} minutes'
         print(runtxt)
-        threads = [Thread(target=self.load_cpus, kwargs=raspiload_context)]
+        threads = [Thread(target=self.run_load, kwargs=raspiload_context)]
         threads.append(
             Thread(target=self.raspi_check, kwargs=raspicheck_context))
         _ = [t.start() for t in threads]
@@ -244,14 +665,48 @@ class RaspiCheck():
         print(', '.join(
             [f"{t.name} {'stopped' if t._is_stopped else 'running'}"
              for t in threads]))
-        filetxt = self.queue.get()
-        fname = self.valid_filename(self.setup)
-        with open(fname, 'a', encoding='utf8') as file:
-            file.write(filetxt)
-        print(f'Check results in file: {self.valid_filename(self.setup)}')
+        self.write_overhead()
+        fname = self.last_fname
+        if 'text' in self.log_format:
+            print(f'Check results in file: {fname}')
+        if 'binary' in self.log_format:
+            bin_fname = self.binary_name(fname)
+            print(f'Binary results in file: {bin_fname}')
+            if 'text' not in self.log_format:
+                fname = bin_fname
         print(f'Finished after {time.time() - start_time:.0f} seconds')
         return fname
 
+    def run_load(self, **kwargs):
+        '''Run load_cpus, keep loop overhead of the workers'''
+        self.load_overheads = self.load_cpus(**kwargs) or []
+
+    def write_overhead(self):
+        '''Add loop overhead of the load workers to the log footer
+
+        With overhead_profile the details are printed and written to
+        <text log>_overhead.json.
+        '''
+        overhead = self.overhead
+        overhead.workers = self.load_overheads
+        if self.text_fname:
+            with open(self.text_fname, 'a', encoding='utf8') as file:
+                for line in overhead.summary_lines():
+                    if line.startswith('# load '):
+                        file.write(line + '\n')
+        if self.overhead_profile:
+            for line in overhead.summary_lines():
+                print(line[2:])
+            fname = self.last_fname[:-len('.txt')] + '_overhead.json'
+            overhead.write_profile(fname)
+            print(f'Overhead profile in file: {fname}')
+
+    def close(self):
+        '''End load workers started by main'''
+        if self.load_pool is not None:
+            self.load_pool.close()
+            self.load_pool = None
+
 
 if __name__ == '__main__':
     rc = RaspiCheck(setup='test')
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Load-free monitoring daemon with a Prometheus metrics endpoint
+
+requires Python 3.7 or later
+
+MetricsDaemon reads the probes of RaspiCheck (no load workers) at most
+once per interval and keeps the samples of the last window seconds in a
+raspidata.RingBuffer. GET /metrics returns the latest values, min/mean/max
+over the window and the CPU time and RSS of the daemon itself in the
+Prometheus text format. The page is rendered once per sample: any number
+of scrapes within one interval cost one set of probes and no rendering.
+Without scrapes the daemon still samples once per interval, so the window
+has no gaps. The HTTP endpoint is a minimal socketserver handler, as
+http.server (which imports email and ssl) would double the memory of the
+daemon.
+
+Usage:
+    python3 raspidaemon.py --listen 127.0.0.1:9755 --interval 10
+    python3 raspi.py --daemon -b sysfs --listen 0.0.0.0:9755
+    curl -s localhost:9755/metrics
+"""
+import sys
+import signal
+import argparse
+import threading
+import socketserver
+import psutil
+from psutil import time
+from raspidata import RingBuffer, FLAGS, cpu_columns
+
+__version__ = '0.0.2'
+
+LISTEN = '127.0.0.1:9755'
+# seconds between samples, probes are never read more often
+INTERVAL = 10.0
+# seconds of samples kept for min/mean/max
+WINDOW = 300.0
+# seconds a scraper may take to send its request
+REQUEST_TIMEOUT = 5.0
+# backend of RaspiCheck, also of raspi.py --daemon
+BACKEND = 'sysfs'
+# longest request or header line read and header lines read
+MAX_LINE = 8192
+MAX_HEADERS = 100
+CONTENT_TYPE = b'text/plain; version=0.0.4; charset=utf-8'
+
+# column, metric name, help text and factor to the base unit
+GAUGES = (('temp', 'raspi_temperature_celsius', 'SoC temperature', 1),
+          ('volt', 'raspi_core_voltage_volts', 'Core voltage', 1),
+          ('freq', 'raspi_cpu_frequency_hertz', 'CPU frequency', 1e9),
+          ('load', 'raspi_cpu_load_percent', 'Average CPU load', 1))
+
+
+def parse_listen(text):
+    '''Return (host, port) of 'host:port' or 'port' '''
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def metric(lines, name, kind, text, samples):
+    '''Append metric in Prometheus text format to lines
+
+    samples = [(labels dict, value)], None values are left out.
+    '''
+    samples = [(labels, value) for labels, value in samples
+               if value is not None]
+    if not samples:
+        return
+    lines.append(f'# HELP {name} {text}')
+    lines.append(f'# TYPE {name} {kind}')
+    for labels, value in samples:
+        label = ','.join(f'{key}="{item}"' for key, item in labels.items())
+        lines.append(f'{name}{{{label}}} {value:g}' if label
+                     else f'{name} {value:g}')
+
+
+class MetricsDaemon():
+    '''Sample probes of RaspiCheck and serve them as metrics'''
+
+    def __init__(self, check, interval=INTERVAL, window=WINDOW):
+        '''check = RaspiCheck, its backend selects the probes'''
+        self.check = check
+        self.interval = max(0.1, float(interval))
+        self.window = float(window)
+        self.ring = RingBuffer(
+            capacity=max(1, round(self.window / self.interval)))
+        # one sample at a time, scrapes wait for a sample in progress
+        self.lock = threading.Lock()
+        self.process = psutil.Process()
+        self.start = time.monotonic()
+        # time.monotonic() of last sample, rendered page of it
+        self.last_sample = None
+        self.page = b''
+        self.samples = 0
+        self.probe_seconds = None
+        self.stop_event = threading.Event()
+
+    def refresh(self) -> bytes:
+        '''Return metrics page, sample first if older than interval'''
+        with self.lock:
+            now = time.monotonic()
+            if (self.last_sample is None
+                    or now - self.last_sample >= self.interval):
+                self.sample(now)
+            return self.page
+
+    def sample(self, now):
+        '''Read probes, keep values and render page'''
+        (throttled, temp, voltage,
+         freq, load, loads) = self.check.read_sample()
+        self.probe_seconds = time.monotonic() - now
+        values = self.check.sample_values(now - self.start, throttled,
+                                          temp, voltage, freq, load, loads)
+        values['throttled_bits'] = throttled
+        self.ring.append(values)
+        self.samples += 1
+        self.last_sample = now
+        self.page = self.render(values).encode('utf8')
+
+    def window_values(self, name) -> list:
+        '''Return values of column name in the window, NaN left out'''
+        if name not in self.ring:
+            return []
+        column = self.ring.columns[name]
+        return [column[row] for row in self.ring.last_rows(self.ring.rows)
+                if column[row] == column[row]]
+
+    def render(self, values) -> str:
+        '''Return metrics of sample values in Prometheus text format'''
+        lines = list()
+        for name, metric_name, text, factor in GAUGES:
+            found = self.window_values(name)
+            samples = [(dict(), values.get(name))]
+            if found:
+                samples += [(dict(stat='min'), min(found)),
+                            (dict(stat='mean'), sum(found) / len(found)),
+                            (dict(stat='max'), max(found))]
+            metric(lines, metric_name, 'gauge', text,
+                   [(labels, None if value is None else value * factor)
+                    for labels, value in samples])
+        metric(lines, 'raspi_cpu_core_load_percent', 'gauge',
+               'CPU load per core',
+               [(dict(cpu=name[len('cpu'):]), values[name])
+                for name in cpu_columns(values)])
+        metric(lines, 'raspi_throttled_bits', 'gauge',
+               'get_throttled bits', [(dict(), values['throttled_bits'])])
+        metric(lines, 'raspi_throttled', 'gauge',
+               'Flag of get_throttled active now',
+               [(dict(flag=flag), values.get(flag)) for flag in FLAGS
+                if flag != 'cpu_nok'])
+        ratios = list()
+        for flag in FLAGS:
+            found = self.window_values(flag)
+            if flag != 'cpu_nok' and found:
+                ratios.append((dict(flag=flag), sum(found) / len(found)))
+        metric(lines, 'raspi_throttled_ratio', 'gauge',
+               'Part of the samples in the window with flag active',
+               ratios)
+        metric(lines, 'raspi_window_seconds', 'gauge',
+               'Seconds of samples in min/mean/max',
+               [(dict(), min(self.window, self.ring.rows * self.interval))])
+        with self.process.oneshot():
+            cpu = self.process.cpu_times()
+            rss = self.process.memory_info().rss
+        metric(lines, 'raspi_daemon_cpu_seconds_total', 'counter',
+               'CPU time of the daemon', [(dict(), cpu.user + cpu.system)])
+        metric(lines, 'raspi_daemon_resident_memory_bytes', 'gauge',
+               'Resident memory of the daemon', [(dict(), rss)])
+        metric(lines, 'raspi_daemon_samples_total', 'counter',
+               'Samples read, at most one per interval',
+               [(dict(), self.samples)])
+        metric(lines, 'raspi_daemon_probe_seconds', 'gauge',
+               'Time to read all probes of the last sample',
+               [(dict(), self.probe_seconds)])
+        return '\n'.join(lines) + '\n'
+
+    def run_sampler(self):
+        '''Sample once per interval while no scrape does it'''
+        while True:
+            due = self.last_sample + self.interval - time.monotonic()
+            if self.stop_event.wait(max(0.0, due)):
+                return
+            self.refresh()
+
+    def serve(self, host='127.0.0.1', port=9755):
+        '''Serve metrics until SIGINT or SIGTERM'''
+        # psutil and /proc/stat loads are differences to the last call
+        self.check.read_sample()
+        time.sleep(min(1.0, self.interval))
+        self.refresh()
+        server = MetricsServer((host, port), MetricsHandler)
+        server.metrics = self
+        sampler = threading.Thread(target=self.run_sampler, daemon=True)
+        sampler.start()
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        print(f'Serving metrics on http://{host}:{port}/metrics, '
+              f'sampling every {self.interval:g} seconds')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop_event.set()
+            server.server_close()
+            sampler.join()
+            self.check.close_sampler()
+
+
+class MetricsServer(socketserver.TCPServer):
+    '''HTTP server answering one scrape at a time'''
+    allow_reuse_address = True
+
+
+class MetricsHandler(socketserver.StreamRequestHandler):
+    '''Answer GET /metrics with the cached page of MetricsDaemon'''
+    timeout = REQUEST_TIMEOUT
+
+    def handle(self):
+        try:
+            request = self.rfile.readline(MAX_LINE).split()
+            for _ in range(MAX_HEADERS):
+                if self.rfile.readline(MAX_LINE) in (b'\r\n', b'\n', b''):
+                    break
+        except OSError:
+            return
+        if len(request) < 2 or request[0] not in (b'GET', b'HEAD'):
+            self.respond(b'405 Method Not Allowed', b'GET only\n')
+        elif request[1].split(b'?')[0] not in (b'/', b'/metrics'):
+            self.respond(b'404 Not Found', b'see /metrics\n')
+        else:
+            self.respond(b'200 OK', self.server.metrics.refresh(),
+                         CONTENT_TYPE, request[0] == b'HEAD')
+
+    def respond(self, status, body, content_type=b'text/plain',
+                head=False):
+        '''Send HTTP/1.0 response and close the connection'''
+        header = (b'HTTP/1.0 ' + status + b'\r\nContent-Type: '
+                  + content_type + b'\r\nContent-Length: '
+                  + str(len(body)).encode() + b'\r\n\r\n')
+        try:
+            self.wfile.write(header if head else header + body)
+        except OSError:
+            pass
+
+
+def run_daemon(check, listen=LISTEN, interval=INTERVAL, window=WINDOW):
+    '''Serve metrics of check on listen = 'host:port' '''
+    host, port = parse_listen(listen)
+    MetricsDaemon(check, interval, window).serve(host, port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve Raspberry Pi metrics for Prometheus')
+    parser.add_argument('--listen', default=LISTEN, metavar='',
+                        help='host:port of the HTTP endpoint')
+    parser.add_argument('-i', '--interval', type=float, default=INTERVAL,
+                        metavar='', help='seconds between samples')
+    parser.add_argument('-w', '--window', type=float, default=WINDOW,
+                        metavar='', help='seconds of min/mean/max')
+    parser.add_argument('-b', '--backend', default=BACKEND,
+                        choices=['psutil', 'sysfs'],
+                        help='read CPU data with psutil/vcgencmd or '
+                             'directly from sysfs')
+    args = parser.parse_args()
+    from raspicheck import RaspiCheck
+    run_daemon(RaspiCheck(backend=args.backend), args.listen,
+               args.interval, args.window)
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar sample store shared by raspicheck and raspianalyse
+
+requires Python 3.7 or later
+
+Every column is one preallocated array('d') filled with NaN, the capacity
+doubles when it is exhausted. Columns are handed out as memoryviews, which
+numpy (np.frombuffer) and matplotlib read without copying.
+
+Sample is the record of one sampler tick: raw numbers in __slots__,
+stored into the columns without building a dict and turned into log
+columns (Sample.values) or text only when a sample is written.
+
+Binary log (.bin) written next to the text log:
+    MAGIC, header length as uint32 little endian, JSON header padded
+    to a multiple of 8 bytes, then one record of float64 per sample
+    with the fields listed in the header (NaN for missing values).
+"""
+import os
+import sys
+import json
+import time
+import string
+import struct
+import unicodedata
+from array import array
+from functools import lru_cache
+
+__version__ = '0.0.10'
+
+NAN = float('nan')
+# seconds between flush and fsync of log files
+FLUSH_INTERVAL = 10.0
+# rows kept in memory before SampleStore.decimate halves them
+MAX_ROWS = 20_000
+
+# columns written by RaspiCheck.raspi_check and read by raspianalyse,
+# per CPU loads follow as cpu0, cpu1, ..., work per second of each load
+# worker as work0, work1, ...
+COLUMNS = ('time', 'cpu_nok', 'undervoltage', 'freq_capped', 'throttled',
+           'soft_temp_limit', 'temp', 'volt', 'freq', 'load', 'late')
+MAGIC = b'RASPIBIN'
+BINARY_VERSION = 1
+# byte order of float64 in this process, default of binary logs
+NATIVE = '<' if sys.byteorder == 'little' else '>'
+# 0/1 columns, decimation keeps a 1 if any of the merged samples had one
+FLAGS = ('cpu_nok', 'undervoltage', 'freq_capped', 'throttled',
+         'soft_temp_limit')
+
+
+def mean(values):
+    '''Return arithmetic mean'''
+    return sum(values) / len(values)
+
+
+def last(values):
+    '''Return last value'''
+    return values[-1]
+
+
+# flag columns and their bits in vcgencmd get_throttled
+FLAG_BITS = (('cpu_nok', 0b111), ('undervoltage', 0b1),
+             ('freq_capped', 0b10), ('throttled', 0b100),
+             ('soft_temp_limit', 0b1000))
+# scalar columns of Sample, in the order of Sample.values
+SCALARS = ('time', 'temp', 'volt', 'freq', 'load', 'late')
+
+
+# how RingBuffer.aggregate merges samples of one column, default mean:
+# any flag set, lowest voltage and frequency and the worst delay survive
+AGGREGATE = dict.fromkeys(FLAGS, max)
+AGGREGATE.update(time=last, volt=min, freq=min, late=max)
+
+
+@lru_cache(maxsize=None)
+def numbered_names(prefix, count) -> tuple:
+    '''Return column names <prefix>0 .. <prefix><count - 1>'''
+    return tuple(f'{prefix}{i}' for i in range(count))
+
+
+def numbered_columns(names, prefix):
+    '''Return names <prefix>0, <prefix>1, ... in order'''
+    size = len(prefix)
+    names = [name for name in names
+             if name.startswith(prefix) and name[size:].isdigit()]
+    return sorted(names, key=lambda name: int(name[size:]))
+
+
+def cpu_columns(names):
+    '''Return names of per CPU load columns in order'''
+    return numbered_columns(names, 'cpu')
+
+
+def work_columns(names):
+    '''Return names of per CPU work per second columns in order'''
+    return numbered_columns(names, 'work')
+
+
+def clean_name(txt) -> str:
+    '''Return txt reduced to characters valid in file names'''
+    valid_chars = "-_. %s%s" % (string.ascii_letters, string.digits)
+    cleaned_txt = unicodedata.normalize('NFKD', txt).encode('ASCII',
+                                                            'ignore')
+    cleaned_txt = cleaned_txt.decode('utf8').replace(' ', '_')
+    return ''.join(c for c in cleaned_txt if c in valid_chars)
+
+
+def flag_max(value, other):
+    '''Return larger flag, NaN only if both are NaN'''
+    if value != value or other > value:
+        return other
+    return value
+
+
+class Sample():
+    '''Values of one sampler tick as numbers, None if not available
+
+    throttled = bits of get_throttled, loads and works = per CPU values.
+    '''
+    __slots__ = ('time', 'throttled', 'temp', 'volt', 'freq', 'load',
+                 'loads', 'late', 'works')
+
+    def __init__(self, time, throttled=None, temp=None, volt=None,
+                 freq=None, load=None, loads=(), late=None, works=()):
+        self.time = time
+        self.throttled = throttled
+        self.temp = temp
+        self.volt = volt
+        self.freq = freq
+        self.load = load
+        self.loads = loads
+        self.late = late
+        self.works = works
+
+    def values(self) -> dict:
+        '''Return sample as dict of SampleStore columns'''
+        values = {name: getattr(self, name) for name in SCALARS}
+        if self.throttled is not None:
+            values.update((name, bool(self.throttled & bits))
+                          for name, bits in FLAG_BITS)
+        values.update(zip(numbered_names('cpu', len(self.loads)),
+                          self.loads))
+        values.update(zip(numbered_names('work', len(self.works)),
+                          self.works))
+        return values
+
+
+class SampleStore():
+    '''Columns of floats with geometrically growing capacity'''
+
+    def __init__(self, names=COLUMNS, capacity=1024):
+        '''Initialise empty columns'''
+        self.capacity = max(1, int(capacity))
+        self.rows = 0
+        self.columns = dict()
+        for name in names:
+            self.add_column(name)
+
+    def add_column(self, name):
+        '''Add column filled with NaN and return it'''
+        if name not in self.columns:
+            self.columns[name] = array('d', [NAN]) * self.capacity
+        return self.columns[name]
+
+    def remove_column(self, name):
+        '''Remove column if available'''
+        self.columns.pop(name, None)
+
+    def new_row(self) -> int:
+        '''Return index of next row, grow capacity if necessary
+
+        Memoryviews returned by __getitem__ must be released before,
+        otherwise the arrays can not be resized.
+        '''
+        if self.rows == self.capacity:
+            for column in self.columns.values():
+                column.extend(array('d', [NAN]) * self.capacity)
+            self.capacity *= 2
+        self.rows += 1
+        return self.rows - 1
+
+    def append(self, values):
+        '''Append row from dict {column: value}, missing values are NaN'''
+        row = self.new_row()
+        for name, value in values.items():
+            if value is not None:
+                self.add_column(name)[row] = value
+        return row
+
+    def append_sample(self, sample):
+        '''Append row from Sample, same columns as append(sample.values())'''
+        row = self.new_row()
+        try:
+            self.store_sample(row, sample)
+        except KeyError:
+            # first sample with these columns
+            for name, value in sample.values().items():
+                if value is not None:
+                    self.add_column(name)
+            self.store_sample(row, sample)
+        return row
+
+    def store_sample(self, row, sample):
+        '''Write Sample to row, KeyError if a column is missing'''
+        columns = self.columns
+        for name in SCALARS:
+            value = getattr(sample, name)
+            if value is not None:
+                columns[name][row] = value
+        if sample.throttled is not None:
+            for name, bits in FLAG_BITS:
+                columns[name][row] = bool(sample.throttled & bits)
+        for prefix, values in (('cpu', sample.loads),
+                               ('work', sample.works)):
+            for name, value in zip(numbered_names(prefix, len(values)),
+                                   values):
+                columns[name][row] = value
+
+    def decimate(self, flags=FLAGS):
+        '''Merge pairs of rows in place, halving the number of rows
+
+        The first row of each pair is kept, for flag columns the larger
+        value, so short throttling events are never dropped.
+        '''
+        rows = self.rows
+        kept = (rows + 1) // 2
+        for name, column in self.columns.items():
+            values = column[0:rows:2]
+            if name in flags:
+                others = column[1:rows:2]
+                others.append(NAN)
+                values = array('d', map(flag_max, values, others))
+            column[:kept] = values
+            column[kept:rows] = array('d', [NAN]) * (rows - kept)
+        self.rows = kept
+
+    def __len__(self):
+        return self.rows
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        '''Return filled part of column as memoryview without copying'''
+        return memoryview(self.columns[name])[:self.rows]
+
+    def get(self, name, default=None):
+        '''Return column or default'''
+        if name in self.columns:
+            return self[name]
+        return default
+
+    def keys(self):
+        '''Return column names'''
+        return self.columns.keys()
+
+    def items(self):
+        '''Return (name, column) pairs'''
+        return [(name, self[name]) for name in self.columns]
+
+    def cpu_columns(self):
+        '''Return names of per CPU load columns in order'''
+        return cpu_columns(self.columns)
+
+    def nbytes(self) -> int:
+        '''Return allocated memory of all columns in bytes'''
+        return sum(column.itemsize * len(column)
+                   for column in self.columns.values())
+
+
+class RingBuffer(SampleStore):
+    '''SampleStore keeping only the last capacity rows'''
+
+    def __init__(self, names=COLUMNS, capacity=1024):
+        '''Initialise empty ring'''
+        super().__init__(names, capacity)
+        # number of rows appended so far, sequence number of next row
+        self.count = 0
+
+    def new_row(self) -> int:
+        '''Return index of next row, overwriting the oldest one'''
+        row = self.count % self.capacity
+        for column in self.columns.values():
+            column[row] = NAN
+        self.count += 1
+        self.rows = min(self.count, self.capacity)
+        return row
+
+    def last_rows(self, n, skip=0) -> list:
+        '''Return indexes of n rows before the last skip rows, oldest first'''
+        n = max(0, min(n, self.rows - skip))
+        start = self.count - skip - n
+        return [(start + i) % self.capacity for i in range(n)]
+
+    def row_values(self, row) -> dict:
+        '''Return values of row, None for NaN'''
+        values = {name: column[row] for name, column in self.columns.items()}
+        return {name: value if value == value else None
+                for name, value in values.items()}
+
+    def aggregate(self, n, skip=0, rules=AGGREGATE) -> dict:
+        '''Return n rows before the last skip rows merged to one row
+
+        Columns are merged as defined in AGGREGATE, columns without any
+        value in these rows are None.
+        '''
+        rows = self.last_rows(n, skip)
+        values = dict()
+        for name, column in self.columns.items():
+            found = [column[row] for row in rows
+                     if column[row] == column[row]]
+            values[name] = rules.get(name, mean)(found) if found else None
+        return values
+
+
+class PeriodicWriter():
+    '''File flushed to disk at most every flush_interval seconds
+
+    flush_interval = 0 flushes after every write. A crash or power loss
+    loses at most the samples of the last flush_interval seconds.
+    '''
+
+    def __init__(self, fname, mode='wb', flush_interval=FLUSH_INTERVAL,
+                 **kwargs):
+        '''Open fname'''
+        self.fname = fname
+        self.flush_interval = flush_interval
+        self.file = open(fname, mode, **kwargs)
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        '''Flush buffers and fsync file'''
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_flush = time.monotonic()
+
+    def flush_due(self):
+        '''Flush if flush_interval has passed since last flush'''
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def write_records(self, data):
+        '''Write bytes of records already packed in the file format'''
+        self.file.write(data)
+        self.flush_due()
+
+    def close(self):
+        '''Flush and close file'''
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TextWriter(PeriodicWriter):
+    '''Append lines to text log'''
+
+    def __init__(self, fname, header=(), flush_interval=FLUSH_INTERVAL):
+        '''Open fname for appending and write header lines'''
+        super().__init__(fname, 'a', flush_interval, encoding='utf8')
+        for line in header:
+            self.file.write(line + '\n')
+        self.flush()
+
+    def write(self, line):
+        '''Write one line'''
+        self.file.write(line + '\n')
+        self.flush_due()
+
+
+class BinaryWriter(PeriodicWriter):
+    '''Write samples as fixed width float64 records'''
+
+    def __init__(self, fname, names, title='', text_fname='',
+                 flush_interval=FLUSH_INTERVAL, byteorder=None):
+        '''Open fname and write header describing the fields
+
+        byteorder '<' or '>' of the records, default native. write swaps
+        the bytes of other orders, write_records takes them as they are.
+        '''
+        super().__init__(fname, 'wb', flush_interval)
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        if byteorder is None:
+            byteorder = NATIVE
+        self.swap = byteorder != NATIVE
+        header = dict(version=BINARY_VERSION,
+                      byteorder=byteorder,
+                      fields=self.names,
+                      title=title,
+                      fname=text_fname)
+        header = json.dumps(header).encode('utf8')
+        header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 8)
+        self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.flush()
+
+    def write(self, values):
+        '''Write one record from dict {field: value}, others are NaN'''
+        record = array('d', [NAN]) * len(self.names)
+        for name, value in values.items():
+            if value is not None and name in self.index:
+                record[self.index[name]] = value
+        if self.swap:
+            record.byteswap()
+        record.tofile(self.file)
+        self.flush_due()
+
+
+def read_header(file) -> dict:
+    '''Return header of binary log, offset is the start of the records'''
+    magic = file.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError(f'{file.name} is not a binary raspi log')
+    size, = struct.unpack('<I', file.read(4))
+    header = json.loads(file.read(size).decode('utf8'))
+    header['offset'] = len(MAGIC) + 4 + size
+    return header
+
+
+def read_records(fname, max_rows=None) -> tuple:
+    '''Return header and {field: array('d')} of binary log
+
+    Read without numpy, at most max_rows records. A partly written last
+    record is ignored.
+    '''
+    with open(fname, 'rb') as file:
+        header = read_header(file)
+        width = 8 * len(header['fields'])
+        size = -1 if max_rows is None else max_rows * width
+        raw = file.read(size)
+    records = array('d', raw[:len(raw) - len(raw) % width])
+    if header['byteorder'] != NATIVE:
+        records.byteswap()
+    step = len(header['fields'])
+    return header, {name: records[i::step]
+                    for i, name in enumerate(header['fields'])}
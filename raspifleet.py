@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+"""
+Stream samples of many Raspberry Pis to one collector
+
+requires Python 3.7 or later
+
+FleetSink is a log writer of RaspiCheck (raspi.py --collector): it sends
+the written samples of one node in batches over TCP or UDP. The collector
+(python3 raspifleet.py) receives the streams of many nodes on one asyncio
+loop and writes one binary log per node and run, which raspianalyse,
+raspirender and raspistats read like any other cr*.bin log.
+
+Frame, integers little endian:
+    HEADER: magic, version, kind, length of node name, sequence number
+            of the first row, number of rows, payload length
+    node name (utf8), then the payload
+    HELLO: JSON {"fields": [...], "title": ..., "start": ...}
+    BATCH: rows records of float64 little endian in field order, the
+           record layout of raspidata.BinaryWriter
+
+The sampler only appends rows to a bounded buffer, a sender thread per
+sink connects, resolves names and sends, so an unreachable collector
+never delays a tick. TCP sends frames of at most batch rows back to back,
+UDP one frame per datagram and the HELLO again every HELLO_INTERVAL
+seconds. Sequence numbers count the rows of a
+run: the collector drops rows it already has (resent after a reconnect)
+and counts missing ones as lost.
+
+Usage:
+    python3 raspifleet.py -o data/fleet/ --tcp 9753 --udp 9753
+    python3 raspi.py "Pi 4 soak" --collector tcp://collector:9753
+"""
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import struct
+import asyncio
+import argparse
+import threading
+from array import array
+from urllib.parse import urlsplit
+from raspidata import PeriodicWriter, BinaryWriter, FLUSH_INTERVAL
+from raspidata import clean_name, read_header
+
+__version__ = '0.0.2'
+
+MAGIC = b'RSPF'
+FRAME_VERSION = 1
+HELLO = 0
+BATCH = 1
+# magic, version, kind, name length, sequence, rows, payload length
+HEADER = struct.Struct('<4sBBHIII')
+PORT = 9753
+# rows sent per frame and seconds after which a smaller batch is sent
+BATCH_ROWS = 10
+BATCH_INTERVAL = 1.0
+# rows kept while the collector is not reachable, older ones are dropped
+MAX_PENDING = 10_000
+# seconds between connection attempts and socket timeout of the sink
+RECONNECT_INTERVAL = 5.0
+SEND_TIMEOUT = 0.5
+# seconds close waits for the sender thread to send pending rows
+CLOSE_TIMEOUT = 5.0
+# seconds between HELLO frames over UDP
+HELLO_INTERVAL = 10.0
+# largest UDP payload sent
+MAX_DATAGRAM = 8192
+# seconds between status lines of the collector
+STATUS_INTERVAL = 10.0
+# receive buffer of the UDP socket, holds bursts of many nodes sending
+# at the same time (limited by net.core.rmem_max)
+UDP_BUFFER = 4 << 20
+
+
+def parse_address(address):
+    '''Return (protocol, host, port) of 'tcp://host:port' or 'host:port' '''
+    if '://' not in address:
+        address = 'tcp://' + address
+    parts = urlsplit(address)
+    if parts.scheme not in ('tcp', 'udp') or not parts.hostname:
+        raise ValueError(f'{address!r} is not tcp://host:port or '
+                         f'udp://host:port')
+    return parts.scheme, parts.hostname, parts.port or PORT
+
+
+def encode_frame(kind, node, seq=0, rows=0, payload=b'') -> bytes:
+    '''Return frame of kind HELLO or BATCH'''
+    name = node.encode('utf8')
+    return HEADER.pack(MAGIC, FRAME_VERSION, kind, len(name), seq, rows,
+                       len(payload)) + name + payload
+
+
+def decode_header(data):
+    '''Return (kind, name length, seq, rows, payload length) of header'''
+    magic, version, kind, size, seq, rows, length = HEADER.unpack(data)
+    if magic != MAGIC or version != FRAME_VERSION:
+        raise ValueError('not a raspifleet frame')
+    return kind, size, seq, rows, length
+
+
+class FleetSink():
+    '''Send samples of one node to a collector in batches
+
+    Used as log writer by RaspiCheck.write_sample. write only appends the
+    row to a buffer of at most max_pending rows, oldest dropped first;
+    a sender thread sends them and keeps them while the collector is not
+    reachable.
+    '''
+
+    def __init__(self, address, names, node=None, title='',
+                 batch=BATCH_ROWS, batch_interval=BATCH_INTERVAL,
+                 max_pending=MAX_PENDING):
+        '''address = 'tcp://host:port' or 'udp://host:port' '''
+        self.protocol, self.host, self.port = parse_address(address)
+        self.node = node or socket.gethostname()
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.batch = max(1, batch)
+        self.batch_interval = batch_interval
+        self.max_pending = max(self.batch, max_pending)
+        hello = dict(fields=self.names, title=title, start=time.time())
+        self.hello = encode_frame(HELLO, self.node,
+                                  payload=json.dumps(hello).encode('utf8'))
+        # pending rows (little endian), sequence number of the first one;
+        # shared with the sender thread under lock
+        self.rows = array('d')
+        self.seq = 0
+        self.lock = threading.Lock()
+        # rows dropped because the collector was not reachable
+        self.lost = 0
+        self.sock = None
+        self.last_send = time.monotonic()
+        self.last_hello = 0.0
+        self.last_connect = None
+        if self.protocol == 'udp':
+            record = 8 * len(self.names)
+            self.frame_rows = max(
+                1, (MAX_DATAGRAM - HEADER.size - 255) // record)
+        else:
+            self.frame_rows = self.batch
+        # set by write when a batch is due, by close to stop the sender
+        self.wake = threading.Event()
+        self.closing = False
+        self.sender = threading.Thread(target=self.run_sender,
+                                       name=f'fleet-{self.node}',
+                                       daemon=True)
+        self.sender.start()
+
+    def connect(self) -> bool:
+        '''Return True if connected, try at most every RECONNECT_INTERVAL'''
+        if self.sock is not None:
+            return True
+        now = time.monotonic()
+        if (self.last_connect is not None
+                and now - self.last_connect < RECONNECT_INTERVAL):
+            return False
+        self.last_connect = now
+        try:
+            if self.protocol == 'tcp':
+                self.sock = socket.create_connection(
+                    (self.host, self.port), SEND_TIMEOUT)
+                self.sock.setsockopt(socket.IPPROTO_TCP,
+                                     socket.TCP_NODELAY, 1)
+            else:
+                family, kind, proto, _, addr = socket.getaddrinfo(
+                    self.host, self.port, type=socket.SOCK_DGRAM)[0]
+                self.sock = socket.socket(family, kind, proto)
+                self.sock.settimeout(SEND_TIMEOUT)
+                self.sock.connect(addr)
+            self.send_hello()
+        except OSError as err:
+            print(f'Collector {self.host}:{self.port} not reachable: {err}')
+            self.disconnect()
+            return False
+        return True
+
+    def send_hello(self):
+        '''Send field names and title of the run'''
+        self.sock.sendall(self.hello)
+        self.last_hello = time.monotonic()
+
+    def disconnect(self):
+        '''Close socket, pending rows are sent after the next connect'''
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def write(self, values):
+        '''Queue one row from dict {field: value}, wake sender if due'''
+        record = array('d', [float('nan')]) * len(self.names)
+        for name, value in values.items():
+            if value is not None and name in self.index:
+                record[self.index[name]] = value
+        if sys.byteorder != 'little':
+            record.byteswap()
+        fields = len(self.names)
+        with self.lock:
+            self.rows.extend(record)
+            pending = len(self.rows) // fields
+            if pending > self.max_pending:
+                dropped = pending - self.max_pending
+                del self.rows[:dropped * fields]
+                self.seq += dropped
+                self.lost += dropped
+                pending = self.max_pending
+        if (pending >= self.batch or time.monotonic() - self.last_send
+                >= self.batch_interval):
+            self.last_send = time.monotonic()
+            self.wake.set()
+
+    def run_sender(self):
+        '''Send pending rows when woken, at least every batch_interval'''
+        while True:
+            self.wake.wait(self.batch_interval)
+            self.wake.clear()
+            closing = self.closing
+            self.flush()
+            if closing:
+                return
+
+    def flush(self):
+        '''Send pending rows, keep them if the collector is not reachable
+
+        Called by the sender thread only, the lock is held while rows
+        are taken or removed, not while sending.
+        '''
+        fields = len(self.names)
+        size = 8 * fields * self.frame_rows
+        while True:
+            with self.lock:
+                if not self.rows:
+                    return
+                seq = self.seq
+                chunk = self.rows[:size // 8].tobytes()
+            if not self.connect():
+                return
+            rows = len(chunk) // (8 * fields)
+            try:
+                if (self.protocol == 'udp' and time.monotonic()
+                        - self.last_hello >= HELLO_INTERVAL):
+                    self.send_hello()
+                self.sock.sendall(encode_frame(BATCH, self.node, seq, rows,
+                                               chunk))
+            except OSError:
+                # the collector drops rows it already has, so a frame cut
+                # in half is simply sent again
+                self.disconnect()
+                return
+            with self.lock:
+                # write may have dropped the oldest rows meanwhile
+                done = max(0, seq + rows - self.seq)
+                del self.rows[:done * fields]
+                self.seq += done
+
+    def close(self):
+        '''Send pending rows and close connection
+
+        Waits at most CLOSE_TIMEOUT seconds for the sender thread.
+        '''
+        self.closing = True
+        self.wake.set()
+        self.sender.join(CLOSE_TIMEOUT)
+        if not self.sender.is_alive():
+            self.disconnect()
+        unsent = self.lost + len(self.rows) // len(self.names)
+        if unsent:
+            print(f'{unsent} samples not sent to collector')
+
+
+class NodeLog():
+    '''Binary log of one run of one node written by the collector'''
+
+    def __init__(self, fname, fields, title,
+                 flush_interval=FLUSH_INTERVAL):
+        '''Open fname for records of fields
+
+        A log with the same fields written before a restart of the
+        collector is continued.
+        '''
+        self.fname = fname
+        self.record_size = 8 * len(fields)
+        # sequence number of the next row expected, None = not known
+        self.next_seq = 0
+        if self.resumable(fields):
+            self.writer = PeriodicWriter(fname, 'ab', flush_interval)
+            self.next_seq = None
+        else:
+            self.writer = BinaryWriter(fname, fields, title=title,
+                                       flush_interval=flush_interval,
+                                       byteorder='<')
+        self.rows = 0
+        self.lost = 0
+        self.repeated = 0
+
+    def resumable(self, fields) -> bool:
+        '''Return True if fname is a log of fields, cut partial record'''
+        try:
+            with open(self.fname, 'rb') as file:
+                header = read_header(file)
+        except (OSError, ValueError):
+            return False
+        if header['fields'] != list(fields) or header['byteorder'] != '<':
+            return False
+        size = os.path.getsize(self.fname) - header['offset']
+        os.truncate(self.fname, header['offset']
+                    + size // self.record_size * self.record_size)
+        return True
+
+    def write(self, seq, rows, payload):
+        '''Write rows starting at sequence number seq'''
+        if self.next_seq is None:
+            self.next_seq = seq
+        if seq < self.next_seq:
+            skip = min(rows, self.next_seq - seq)
+            self.repeated += skip
+            payload = payload[skip * self.record_size:]
+            seq += skip
+            rows -= skip
+        if not rows:
+            return
+        self.lost += seq - self.next_seq
+        self.writer.write_records(payload)
+        self.rows += rows
+        self.next_seq = seq + rows
+
+    def close(self):
+        '''Flush and close log'''
+        self.writer.close()
+
+
+class FleetCollector():
+    '''Receive frames of many nodes, one NodeLog per node and run'''
+
+    def __init__(self, path='data/fleet/', flush_interval=FLUSH_INTERVAL):
+        '''Write logs to directory path'''
+        self.path = path
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+        # {(node, start): NodeLog}, {node: (node, start) of current run}
+        self.logs = dict()
+        self.current = dict()
+        self.frames = 0
+        self.rows = 0
+        self.errors = 0
+        # rows of nodes whose HELLO was not received yet (UDP)
+        self.unknown = 0
+
+    def log_fname(self, node, title, start) -> str:
+        '''Return name of binary log of one run of node'''
+        dtime = time.strftime('%Y-%m-%d-%H%M%S', time.localtime(start))
+        return os.path.join(self.path, f'cr{dtime}_{clean_name(node)}_'
+                                       f'{clean_name(title)}.bin')
+
+    def hello(self, node, payload):
+        '''Open log of a new run of node, close its previous run'''
+        hello = json.loads(payload.decode('utf8'))
+        key = (node, hello['start'])
+        if key in self.logs:
+            return
+        previous = self.current.get(node)
+        if previous is not None:
+            self.logs.pop(previous).close()
+        fname = self.log_fname(node, hello.get('title', ''), hello['start'])
+        self.logs[key] = NodeLog(fname, hello['fields'],
+                                 f'{node}: {hello.get("title", "")}',
+                                 self.flush_interval)
+        self.current[node] = key
+        print(f'{node} started {fname}')
+
+    def handle(self, kind, node, seq, rows, payload):
+        '''Handle one decoded frame'''
+        self.frames += 1
+        if kind == HELLO:
+            self.hello(node, payload)
+            return
+        key = self.current.get(node)
+        if kind != BATCH or key is None:
+            self.unknown += rows
+            return
+        log = self.logs[key]
+        if len(payload) != rows * log.record_size:
+            self.errors += 1
+            return
+        log.write(seq, rows, payload)
+        self.rows += rows
+
+    def datagram(self, data):
+        '''Handle frame received over UDP'''
+        try:
+            kind, size, seq, rows, length = decode_header(
+                data[:HEADER.size])
+            end = HEADER.size + size
+            if len(data) != end + length:
+                raise ValueError('truncated frame')
+            node = data[HEADER.size:end].decode('utf8')
+            self.handle(kind, node, seq, rows, data[end:])
+        except (ValueError, KeyError, struct.error):
+            self.errors += 1
+
+    async def stream(self, reader, writer):
+        '''Handle frames of one TCP connection until it is closed'''
+        try:
+            while True:
+                kind, size, seq, rows, length = decode_header(
+                    await reader.readexactly(HEADER.size))
+                data = await reader.readexactly(size + length)
+                self.handle(kind, data[:size].decode('utf8'), seq, rows,
+                            data[size:])
+        except (asyncio.IncompleteReadError, asyncio.CancelledError):
+            # connection closed by the node or collector stopped
+            pass
+        except (ValueError, KeyError, OSError):
+            self.errors += 1
+        finally:
+            writer.close()
+
+    def status(self) -> str:
+        '''Return one line of counters'''
+        lost = sum(log.lost for log in self.logs.values())
+        return (f'{len(self.current)} nodes, {self.frames} frames, '
+                f'{self.rows} rows, {lost} lost, {self.unknown} unknown, '
+                f'{self.errors} errors')
+
+    async def serve(self, host='', tcp_port=PORT, udp_port=None,
+                    stop=None):
+        '''Receive until stop (asyncio.Event) is set'''
+        loop = asyncio.get_running_loop()
+        stop = stop or asyncio.Event()
+        servers = list()
+        if tcp_port is not None:
+            servers.append(await asyncio.start_server(
+                self.stream, host or None, tcp_port))
+        if udp_port is not None:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: DatagramReceiver(self), (host or '0.0.0.0', udp_port))
+            transport.get_extra_info('socket').setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER)
+            servers.append(transport)
+        try:
+            while not stop.is_set():
+                try:
+                    await asyncio.wait_for(stop.wait(), STATUS_INTERVAL)
+                except asyncio.TimeoutError:
+                    print(self.status())
+        finally:
+            for server in servers:
+                server.close()
+
+    def close(self):
+        '''Close all logs'''
+        for log in self.logs.values():
+            log.close()
+        self.logs.clear()
+        self.current.clear()
+
+
+class DatagramReceiver(asyncio.DatagramProtocol):
+    '''Pass UDP datagrams to FleetCollector'''
+
+    def __init__(self, collector):
+        self.collector = collector
+
+    def datagram_received(self, data, addr):
+        self.collector.datagram(data)
+
+
+async def run_collector(collector, host, tcp_port, udp_port):
+    '''Serve until SIGINT or SIGTERM'''
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await collector.serve(host, tcp_port, udp_port, stop)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Collect samples streamed by raspi.py --collector')
+    parser.add_argument('-o', '--output', default='data/fleet/', metavar='',
+                        help='directory of the logs, one per node and run')
+    parser.add_argument('--host', default='', metavar='',
+                        help='address to listen on, default all')
+    parser.add_argument('--tcp', type=int, default=PORT, metavar='',
+                        help='TCP port, 0 = no TCP')
+    parser.add_argument('--udp', type=int, default=PORT, metavar='',
+                        help='UDP port, 0 = no UDP')
+    parser.add_argument('--flush', type=float, default=FLUSH_INTERVAL,
+                        metavar='',
+                        help='seconds between writing logs to disk')
+    args = parser.parse_args()
+    fleet = FleetCollector(args.output, args.flush)
+    try:
+        asyncio.run(run_collector(fleet, args.host, args.tcp or None,
+                                  args.udp or None))
+    finally:
+        print(fleet.status())
+        fleet.close()
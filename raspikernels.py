@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Workload kernels for raspiload
+
+requires Python 3.7 or later
+
+Every kernel is called repeatedly by raspiload.load_single_cpu, each call
+does `work` units of `unit` (operations, bytes, ...), so the work done per
+second can be reported next to the CPU load. Kernels using NumPy raise
+ValueError if NumPy is not installed.
+"""
+import os
+import math
+import random
+import tempfile
+
+__version__ = '0.0.1'
+
+
+def import_numpy():
+    '''Return numpy module, raise ValueError if not installed'''
+    # one BLAS thread per load process, otherwise CPUs are loaded twice
+    for name in ('OPENBLAS_NUM_THREADS', 'OMP_NUM_THREADS'):
+        os.environ.setdefault(name, '1')
+    try:
+        import numpy
+    except ImportError:
+        raise ValueError('kernel requires numpy') from None
+    return numpy
+
+
+def format_rate(value, unit) -> str:
+    '''Return value per second with SI prefix, e.g. 1.23 GB/s'''
+    for prefix, factor in (('G', 1e9), ('M', 1e6), ('k', 1e3)):
+        if value >= factor:
+            return f'{value / factor:.2f} {prefix}{unit}/s'
+    return f'{value:.2f} {unit}/s'
+
+
+class Kernel():
+    '''Scalar floating point kernel, one log() of a random number'''
+    name = 'fpu'
+    unit = 'ops'
+    work = 1
+
+    def __call__(self):
+        _ = math.log(random.random())
+
+    def close(self):
+        '''Release resources'''
+
+
+class MatmulKernel(Kernel):
+    '''Vectorised matrix multiplication, FLOPs per call'''
+    name = 'matmul'
+    unit = 'FLOP'
+
+    def __init__(self, size=64):
+        np = import_numpy()
+        self.a = np.random.random((size, size))
+        self.b = np.random.random((size, size))
+        self.work = 2 * size ** 3
+
+    def __call__(self):
+        self.a @ self.b
+
+
+class FFTKernel(Kernel):
+    '''Vectorised FFT, approximated FLOPs (5 n log2 n) per call'''
+    name = 'fft'
+    unit = 'FLOP'
+
+    def __init__(self, size=4096):
+        np = import_numpy()
+        self.fft = np.fft.fft
+        self.data = np.random.random(size)
+        self.work = 5 * size * math.log2(size)
+
+    def __call__(self):
+        self.fft(self.data)
+
+
+class MemoryKernel(Kernel):
+    '''Copy chunks of a large buffer, bytes read and written per call'''
+    name = 'memory'
+    unit = 'B'
+
+    def __init__(self, size=64 << 20, chunk=1 << 20):
+        self.src = memoryview(bytearray(size))
+        self.dst = memoryview(bytearray(chunk))
+        self.chunk = chunk
+        self.offsets = range(0, size - chunk + 1, chunk)
+        self.index = 0
+        self.work = 2 * chunk
+
+    def __call__(self):
+        offset = self.offsets[self.index]
+        self.dst[:] = self.src[offset:offset + self.chunk]
+        self.index = (self.index + 1) % len(self.offsets)
+
+
+class CacheKernel(Kernel):
+    '''Random reads over a buffer larger than the caches, reads per call'''
+    name = 'cache'
+    unit = 'reads'
+
+    def __init__(self, size=32 << 20, reads=4096):
+        np = import_numpy()
+        self.data = np.zeros(size // 8)
+        self.index = np.random.randint(0, len(self.data), reads)
+        self.shuffle = np.random.shuffle
+        self.work = reads
+
+    def __call__(self):
+        self.data[self.index].sum()
+        self.shuffle(self.index)
+
+
+class IOKernel(Kernel):
+    '''Write and fsync a temporary file, bytes written per call'''
+    name = 'io'
+    unit = 'B'
+
+    def __init__(self, chunk=256 << 10, size=16 << 20):
+        self.file = tempfile.TemporaryFile()
+        self.fd = self.file.fileno()
+        self.data = os.urandom(chunk)
+        self.offsets = range(0, size, chunk)
+        self.index = 0
+        self.work = chunk
+
+    def __call__(self):
+        os.pwrite(self.fd, self.data, self.offsets[self.index])
+        os.fsync(self.fd)
+        self.index = (self.index + 1) % len(self.offsets)
+
+    def close(self):
+        '''Remove temporary file'''
+        self.file.close()
+
+
+KERNELS = {kernel.name: kernel for kernel in (Kernel, MatmulKernel,
+                                              FFTKernel, MemoryKernel,
+                                              CacheKernel, IOKernel)}
@@ -3,16 +3,58 @@
 Created on Tue Apr  7 13:31:33 2020
 
 @author: GFI
-requires Python 3.6 or later
+requires Python 3.7 or later
+
+LoadPool keeps one worker process per core alive between runs. Jobs go
+over one pipe per worker, all workers of a run meet at a barrier and start
+their profiles at one shared time.monotonic() epoch, so load steps change
+on all cores at the same moment.
+
+Every worker measures its own loop overhead (time spent in the PWM loop
+outside the kernel and outside sleep) and how late it wakes up from each
+idle phase; load_cpus returns these per worker for the log footer.
 """
-import math
+import os
 import time
-import random
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Barrier, Event, Pipe, Process, Value, cpu_count
 from functools import partial
-from threading import Thread
+from threading import Thread, BrokenBarrierError
+from raspikernels import KERNELS, format_rate
+from raspiprofile import Profile
+
+__version__ = '0.0.21'
+
+# seconds of one busy/idle cycle of load_single_cpu
+PWM_PERIOD = 0.1
+# seconds to measure speed of load function
+CALIBRATION_TIME = 0.05
+# seconds between the last worker reaching the start barrier and epoch
+START_LEAD = 0.01
+# shared array of work done per worker and event stopping the load,
+# set by init_worker
+work_counters = None
+stop_event = None
+# calls per ms of each kernel, measured once per worker process
+calibrations = dict()
+# seconds of bookkeeping per batch (clock read, counter), measured once
+batch_cost = None
+
+
+def init_worker(counters, stop=None):
+    '''Set shared work counters and stop event in load worker'''
+    global work_counters, stop_event
+    work_counters = counters
+    stop_event = stop
 
-__version__ = '0.0.13'
+
+def stopped() -> bool:
+    '''Return True if LoadPool.stop was called'''
+    return stop_event is not None and stop_event.is_set()
+
+
+def set_epoch(epoch, lead=START_LEAD):
+    '''Set shared start time, run by the last worker at the barrier'''
+    epoch.value = time.monotonic() + lead
 
 
 # def time_counter(timeout=5):
@@ -31,62 +73,195 @@ def time_counter():
         resp = yield round(el_time, 3)
 
 
+def available_cores() -> list:
+    '''Return numbers of cores this process may run on'''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(cpu_count()))
+
+
+def pin_to(cores):
+    '''Restrict calling thread to cores, ignored if not supported
+
+    Return True if the affinity was set.
+    '''
+    if not cores or not hasattr(os, 'sched_setaffinity'):
+        return False
+    try:
+        os.sched_setaffinity(0, set(cores))
+    except OSError as err:
+        print(f'CPU affinity {sorted(cores)} not set: {err}')
+        return False
+    return True
+
+
+def calibrate(load_func, duration=CALIBRATION_TIME) -> float:
+    '''Return calls of load_func per millisecond'''
+    calls = 0
+    batch = 1
+    stime = time.perf_counter()
+    elapsed = 0
+    while elapsed < duration:
+        for _ in range(batch):
+            load_func()
+        calls += batch
+        batch *= 2
+        elapsed = time.perf_counter() - stime
+    return calls / elapsed / 1000
+
+
+def measure_batch_cost(repeat=1000) -> float:
+    '''Return seconds of the bookkeeping done after every batch'''
+    global batch_cost
+    if batch_cost is None:
+        counters = [0.0]
+        now = end = time.monotonic() + 1
+        stime = time.perf_counter()
+        for _ in range(repeat):
+            counters[0] += 1.0
+            now = time.monotonic()
+            if now > end:
+                break
+        batch_cost = (time.perf_counter() - stime) / repeat
+    return batch_cost
+
+
 def load_single_cpu(cpu_nr=0, timeout=6,
                     load_plan=[(3, 0.5), (4, 1.0)],
-                    load_func=None):
+                    load_func=None, period=PWM_PERIOD, kernel='fpu',
+                    affinity=None, barrier=None, epoch=None, stats=None):
     '''
     load CPI in intervalls
     - timeout = time to run load
     - load_plan changing load during runtime
-      [(time_slice, loadpct)),]
+      [(time_slice, loadpct)),] or raspiprofile.Profile
     - load_func = function run for processor load
+    - period = PWM period in seconds, loadpct of each period is busy
+    - kernel = name of workload in raspikernels.KERNELS,
+      used if load_func is None
+    - affinity = cores the worker may run on, None = any
+    - barrier, epoch = start barrier and shared start time of LoadPool
+    - stats = dict filled with the loop overhead of the worker
+
+    load_func is calibrated at start (kernels once per process) and
+    called in batches of about 1 ms between checks of the monotonic
+    clock. Busy and idle phases follow absolute deadlines. The achieved
+    duty cycle (CPU time / wall time) of each step (profile segment) is
+    printed and returned together with the throughput of the kernel
+    while busy. Work done is added to work_counters[cpu_nr-1] after every
+    batch if the worker was started by load_cpus with counters.
     '''
-    def _load_func():
-        '''Function to load cpu'''
-        _ = math.log(random.random())
     if timeout == 0:
         return
     cpname = f'CPU[{cpu_nr:2.0f}] '
-    _times, loads = zip(*load_plan)
-    times_sum = sum(_times)
-    times = [round(timeout * t / times_sum, 1) for t in _times]
-    times = [sum(times[:i]) for i in range(1, len(times) + 1)]
-    _load_plan = [(t, l) for t, l in zip(times, loads)]
+    pin_to(affinity)
+    if isinstance(load_plan, Profile):
+        profile = load_plan
+    else:
+        profile = Profile.from_plan(load_plan, timeout)
     if load_func is None:
-        load_func = _load_func
-    start_functime = time.time()
-    tcounter = time_counter()
-    next(tcounter)
-    runtime = -0.1
-    ftext = f'{cpname} load started after {next(tcounter):.0f}' \
-            f' seconds for {timeout:.0f} seconds'
+        load_func = KERNELS[kernel]()
+        work, unit = load_func.work, load_func.unit
+        if kernel not in calibrations:
+            calibrations[kernel] = calibrate(load_func)
+        calls_per_ms = calibrations[kernel]
+    else:
+        work, unit = 1, 'calls'
+        calls_per_ms = calibrate(load_func)
+    batch = range(max(1, round(calls_per_ms)))
+    batch_work = len(batch) * work
+    cost = measure_batch_cost()
+    counters = work_counters
+    slot = cpu_nr - 1
+    if counters is not None and not 0 <= slot < len(counters):
+        counters = None
+    ftext = f'{cpname} load started for {timeout:.0f} seconds, ' \
+            f'{len(batch)} calls per ms'
     print(ftext)
-    load_counter = time_counter()
-    next(load_counter)
-    while next(tcounter) < timeout:
-        # print(f'1 {next(tcounter)} seconds')
-        if next(tcounter) > runtime and _load_plan:
-            runtime, loadpct = _load_plan.pop(0)
-            ftext = f'{cpname} {loadpct:4.0%} load started' \
-                    f' after {next(tcounter):4.0f} seconds'
-            print(ftext)
-            load_time = max(0, min(1, loadpct))
-        load_counter.send('reset')
-        # print(f'2 {next(tcounter)} seconds')
-        while next(load_counter) < load_time:
-            _ = load_func()
-        # print(f'3 {next(tcounter)} seconds')
-        while next(load_counter) < 1:
-            sleep_time = abs(min(1 - next(load_counter), 1 - load_time))
-            time.sleep(sleep_time)
-            # print('sleep')
-        # print(f'4 {next(tcounter)} seconds')
-    try:
-        tcounter.send('stop')
-    except StopIteration:
-        pass
-    runtime = time.time() - start_functime
-    ftext = f'{cpname} load terminated after {runtime:3.1f} seconds'
+    if barrier is not None:
+        barrier.wait()
+        start = epoch.value
+        time.sleep(max(0, start - time.monotonic()))
+    else:
+        start = time.monotonic()
+    # delay of the first load period after the common start
+    lag = time.monotonic() - start
+    end = start + timeout
+    achieved = list()
+    period_start = start
+    # loop overhead: seconds outside kernel and sleep, wake-up delays
+    # after sleep, busy phases running past their end
+    batches = periods = 0
+    control = overshoot = overshoot_max = 0.0
+    wakes, wake_late, wake_max = 0, 0.0, 0.0
+    for step_begin, step_end, segment in profile.steps(timeout):
+        if stopped():
+            break
+        step_begin = start + step_begin
+        step_end = min(start + step_end, end)
+        if period_start < step_begin:
+            # idle until a segment with absolute start time
+            time.sleep(max(0, step_begin - time.monotonic()))
+            period_start = step_begin
+        label = segment.label()
+        ftext = f'{cpname} {label} load started' \
+                f' after {time.monotonic() - start:4.0f} seconds'
+        print(ftext)
+        step_start, cpu_start = time.monotonic(), time.process_time()
+        calls, busy = 0, 0
+        while period_start < step_end and not stopped():
+            top = time.monotonic()
+            duty = max(0, min(1, segment(period_start - step_begin)))
+            busy_end = period_start + duty * period
+            busy_start = now = time.monotonic()
+            while now < busy_end:
+                for _ in batch:
+                    load_func()
+                calls += len(batch)
+                batches += 1
+                if counters is not None:
+                    counters[slot] += batch_work
+                now = time.monotonic()
+            busy += now - busy_start
+            if duty and now > busy_end:
+                overshoot += now - busy_end
+                overshoot_max = max(overshoot_max, now - busy_end)
+            periods += 1
+            period_start += period
+            before_sleep = time.monotonic()
+            control += busy_start - top + before_sleep - now
+            sleep_time = period_start - before_sleep
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+                late = time.monotonic() - period_start
+                wakes += 1
+                wake_late += late
+                wake_max = max(wake_max, late)
+        walltime = time.monotonic() - step_start
+        if walltime > 0:
+            duty = (time.process_time() - cpu_start) / walltime
+            rate = format_rate(calls * work / busy if busy else 0, unit)
+            achieved.append((label.strip(), duty, rate))
+            print(f'{cpname} {label} load achieved {duty:4.0%}, '
+                  f'{rate} while busy')
+    if hasattr(load_func, 'close'):
+        load_func.close()
+    runtime = time.monotonic() - start
+    ftext = f'{cpname} load terminated after {runtime:3.1f} seconds, '
+    if barrier is not None:
+        ftext += f'started {lag * 1000:.1f} ms after epoch, '
+    loop_overhead = (control + batches * cost) / runtime if runtime else 0
+    ftext += f'loop overhead {loop_overhead:.3%}, '
+    if stats is not None:
+        stats.update(cpu=cpu_nr - 1, periods=periods, batches=batches,
+                     loop_overhead=loop_overhead,
+                     wake_late_mean=wake_late / wakes if wakes else None,
+                     wake_late_max=wake_max if wakes else None,
+                     overshoot_mean=overshoot / periods if periods
+                     else None,
+                     overshoot_max=overshoot_max)
+    ftext += 'achieved ' + ', '.join(f'{label}: {duty:.0%} {rate}'
+                                     for label, duty, rate in achieved)
     return ftext
 
 
@@ -96,26 +271,207 @@ def sleep_until(seconds=1):
     print(time.time())
 
 
-def load_cpus(timeout=3, load_plan=[(1, 0.5)], max_cpus=None, delay=0):
-    '''load cpu with defined percentage'''
+def load_worker(conn, barrier, epoch, counters, stop):
+    '''Run load_single_cpu for every job received until None
+
+    Sends (result text, loop overhead stats) of every job.
+    '''
+    init_worker(counters, stop)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        stats = dict()
+        try:
+            if job['load_plan'] is None:
+                # idle core, keeps the barrier complete
+                barrier.wait()
+                result = None
+            else:
+                result = load_single_cpu(barrier=barrier, epoch=epoch,
+                                         stats=stats, **job)
+        except BrokenBarrierError:
+            result = f'CPU[{job["cpu_nr"]:2.0f}]  start aborted'
+        except Exception as err:
+            barrier.abort()
+            result = f'CPU[{job["cpu_nr"]:2.0f}]  load failed: {err!r}'
+        conn.send((result, stats or None))
+
+
+class LoadPool():
+    '''Long-lived load workers, one per core
+
+    Workers are started once and take jobs (timeout, profile, kernel) over
+    a pipe, so back to back runs do not pay the process start again.
+    '''
+
+    def __init__(self, cores=None, counters=None, reserved=None):
+        '''Start one worker per core, without the reserved core
+
+        counters = multiprocessing.Array('d', lock=False), the worker of
+        core n adds its work done to counters[n]
+        '''
+        if cores is None:
+            cores = available_cores()
+        self.reserved = reserved
+        self.cores = [core for core in cores if core != reserved]
+        if not self.cores:
+            raise ValueError('no core left for load workers')
+        self.epoch = Value('d', 0.0, lock=False)
+        self.stop_event = Event()
+        self.barrier = Barrier(len(self.cores),
+                               action=partial(set_epoch, self.epoch))
+        self.workers = dict()
+        for core in self.cores:
+            conn, child = Pipe()
+            process = Process(target=load_worker, name=f'load-{core}',
+                              args=(child, self.barrier, self.epoch,
+                                    counters, self.stop_event),
+                              daemon=True)
+            process.start()
+            self.workers[core] = process, conn
+        self.running = False
+        # loop overhead stats of the workers in the last run
+        self.overheads = list()
+
+    def start(self, plans, timeout, period=PWM_PERIOD, kernel='fpu',
+              pin=False):
+        '''Send jobs of one run without waiting for the results
+
+        plans = {core: Profile}, cores without plan stay idle
+        pin = pin every worker to its core, otherwise all cores but the
+        reserved one are allowed
+        '''
+        if self.running:
+            raise RuntimeError('load pool is already running')
+        unknown = set(plans) - set(self.cores)
+        if unknown:
+            raise ValueError(f'no load worker for cores {sorted(unknown)}')
+        if timeout <= 0:
+            return
+        self.stop_event.clear()
+        if self.barrier.broken:
+            self.barrier.reset()
+        allowed = [core for core in available_cores()
+                   if core != self.reserved]
+        for core, (_, conn) in self.workers.items():
+            conn.send(dict(cpu_nr=core + 1, timeout=timeout,
+                           load_plan=plans.get(core), period=period,
+                           kernel=kernel,
+                           affinity={core} if pin else allowed))
+        self.running = True
+
+    def join(self) -> list:
+        '''Wait for the end of the run, return results of the workers'''
+        results = list()
+        if not self.running:
+            return results
+        self.overheads = list()
+        for process, conn in self.workers.values():
+            try:
+                result, stats = conn.recv()
+            except EOFError:
+                result, stats = f'{process.name} died', None
+            results.append(result)
+            if stats:
+                self.overheads.append(stats)
+        self.running = False
+        return [result for result in results if result]
+
+    def run(self, plans, timeout, period=PWM_PERIOD, kernel='fpu',
+            pin=False) -> list:
+        '''Run plans and return results of the workers'''
+        self.start(plans, timeout, period, kernel, pin)
+        return self.join()
+
+    def stop(self):
+        '''End the current run early'''
+        self.stop_event.set()
+
+    def close(self):
+        '''Stop current run and end all workers'''
+        if self.running:
+            self.stop()
+            self.join()
+        for process, conn in self.workers.values():
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(timeout=1)
+            conn.close()
+        self.workers = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_cpus(timeout=3, load_plan=[(1, 0.5)], max_cpus=None, delay=0,
+              period=PWM_PERIOD, kernel='fpu', counters=None,
+              load_plans=None, pin=False, reserved=None, profile=None,
+              pool=None):
+    '''load cpu with defined percentage
+
+    counters = multiprocessing.Array('d', lock=False), worker n adds
+    its work done to counters[n - 1]
+    load_plans = {core: load_plan or Profile}, one worker per core with
+    its own plan, other cores stay idle; replaces load_plan and max_cpus
+    profile = raspiprofile.Profile used instead of load_plan
+    pin = pin worker n to core n - 1 (os.sched_setaffinity)
+    reserved = core kept free of load, e.g. for the sampler
+    pool = LoadPool reused for this run, its counters and reserved core
+    apply; without pool a LoadPool is started for this run only
+
+    Returns the loop overhead stats of the workers, see load_single_cpu.
+    '''
     if delay > 0:
         print(f'Start CPU load delayed by {delay:.0f} seconds')
         time.sleep(delay)
         timeout = max(0, timeout - delay)
-    if max_cpus is None or max_cpus > cpu_count():
-        processes = cpu_count()
+    if pool is not None:
+        reserved = pool.reserved
+        cores = pool.cores
+    else:
+        cores = [core for core in available_cores() if core != reserved]
+    if load_plans:
+        if reserved in load_plans:
+            raise ValueError(f'core {reserved} is reserved')
+        plans = dict(sorted(load_plans.items()))
     else:
-        processes = max_cpus
-    func = partial(load_single_cpu, load_plan=load_plan, timeout=timeout)
+        plans = dict.fromkeys(cores[:max_cpus], profile or load_plan)
+    plans = {core: plan if isinstance(plan, Profile)
+             else Profile.from_plan(plan, timeout)
+             for core, plan in plans.items()}
+    if not plans:
+        print('No core left for CPU load')
+        return []
+    processes = len(plans)
     ftext = (f'Start test for {timeout:.0f} seconds '
              f'on {processes:.0f} CPUs '
-             f'with initially {load_plan[0][1]:.0%} load')
+             f'with initially {next(iter(plans.values()))(0):.0%} '
+             f'{kernel} load')
+    pin = bool(load_plans or pin)
+    if pin:
+        ftext += f', pinned to cores {list(plans)}'
     print(ftext)
-    params = [i + 1 for i in range(processes)]
     stime = time.time()
-    with Pool(processes=processes) as pool:
-        _ = pool.map(func, params)
+    if pool is None:
+        with LoadPool(list(plans), counters) as run_pool:
+            results = run_pool.run(plans, timeout, period, kernel, pin)
+            overheads = run_pool.overheads
+    else:
+        results = pool.run(plans, timeout, period, kernel, pin)
+        overheads = pool.overheads
+    for result in results:
+        print(result)
     print(f'Load CPUs terminated after {time.time()-stime:.2f} sec')
+    return overheads
 
 
 if __name__ == '__main__':
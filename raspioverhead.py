@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Self-overhead of raspi-info: probe latency, tick jitter, CPU time and RSS
+
+requires Python 3.7 or later
+
+RaspiCheck records into an Overhead for every run:
+- latency of every probe (ProbeScheduler threads and direct reads)
+- tick jitter, seconds the tick started after its scheduled time, and
+  the work per tick (probes, ring buffer, writing)
+- CPU time of the sampler process and of the probe subprocesses
+  (vcgencmd), RSS and peak RSS, from psutil.Process()
+- the loop overhead of each load worker, returned by raspiload
+
+Histograms have fixed logarithmic buckets, adding a value costs one
+bisect. summary_lines() is written as '# ' footer to the text log,
+profile() is the detailed version written as JSON with raspi.py
+--overhead.
+"""
+import json
+import threading
+from bisect import bisect_left
+import psutil
+from psutil import time
+
+__version__ = '0.0.1'
+
+# upper bucket edges in seconds, 1 us .. 10 s in 1-2-5 steps
+EDGES = tuple(m * 10.0 ** e for e in range(-6, 1) for m in (1, 2, 5)) \
+    + (10.0,)
+
+
+def format_ms(seconds) -> str:
+    '''Return seconds as ms text with 2 significant digits or more'''
+    if seconds is None:
+        return '-'
+    return f'{seconds * 1000:.2g} ms' if seconds < 0.01 \
+        else f'{seconds * 1000:.0f} ms'
+
+
+class Histogram():
+    '''Latency histogram with fixed logarithmic buckets'''
+
+    def __init__(self):
+        self.counts = [0] * (len(EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        '''Add one latency in seconds'''
+        self.counts[bisect_left(EDGES, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q) -> float:
+        '''Return upper bucket edge below which q % of the values are'''
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for edge, count in zip(EDGES + (self.max,), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(edge, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        '''Return count, mean, p50, p99 and max in seconds'''
+        return dict(count=self.count,
+                    mean=self.total / self.count if self.count else None,
+                    p50=self.percentile(50), p99=self.percentile(99),
+                    max=self.max if self.count else None)
+
+    def as_dict(self) -> dict:
+        '''Return summary and non-empty buckets {upper edge: count}'''
+        buckets = {f'{edge:g}': count for edge, count
+                   in zip(EDGES + (float('inf'),), self.counts) if count}
+        return dict(self.summary(), buckets=buckets)
+
+
+class Overhead():
+    '''Footprint of one sampler run'''
+
+    def __init__(self):
+        self.histograms = dict()
+        self.process = psutil.Process()
+        self.start_times = None
+        self.start_wall = None
+        self.cpu = dict()
+        self.rss = None
+        self.peak_rss = None
+        self.threads = dict()
+        # loop overhead of the load workers, see raspiload.load_single_cpu
+        self.workers = list()
+
+    def histogram(self, name) -> Histogram:
+        '''Return histogram name, created on first use'''
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def add(self, name, seconds):
+        '''Add latency of name'''
+        self.histogram(name).add(seconds)
+
+    def timed(self, name, func):
+        '''Return func recording its latency as probe name'''
+        histogram = self.histogram(name)
+
+        def probe():
+            start = time.perf_counter()
+            try:
+                return func()
+            finally:
+                histogram.add(time.perf_counter() - start)
+        return probe
+
+    def start(self):
+        '''Take CPU times at the start of the run'''
+        self.start_times = self.process.cpu_times()
+        self.start_wall = time.monotonic()
+
+    def stop(self):
+        '''Take CPU times and memory at the end of the run'''
+        times = self.process.cpu_times()
+        wall = time.monotonic() - self.start_wall
+        before = self.start_times
+        # clock tick sums may differ by a rounding error below zero
+        self.cpu = dict(
+            wall=wall,
+            sampler=max(0.0, times.user + times.system
+                        - before.user - before.system),
+            subprocesses=max(0.0, times.children_user
+                             + times.children_system
+                             - before.children_user
+                             - before.children_system))
+        self.rss = self.process.memory_info().rss
+        # ru_maxrss is updated lazily, it may lag behind the RSS
+        self.peak_rss = max(self.read_peak_rss() or 0, self.rss)
+        self.threads = self.thread_times()
+
+    @staticmethod
+    def read_peak_rss():
+        '''Return peak RSS of this process in bytes or None'''
+        try:
+            import resource
+        except ImportError:
+            return None
+        # kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def thread_times(self) -> dict:
+        '''Return {thread name: CPU seconds} of threads still alive'''
+        names = {thread.native_id: thread.name
+                 for thread in threading.enumerate()
+                 if getattr(thread, 'native_id', None)}
+        try:
+            threads = self.process.threads()
+        except psutil.Error:
+            return {}
+        return {names.get(thread.id, str(thread.id)):
+                thread.user_time + thread.system_time
+                for thread in threads}
+
+    def summary_lines(self) -> list:
+        '''Return summary as '# ' lines for the log footer'''
+        lines = list()
+        if self.cpu:
+            wall = max(self.cpu['wall'], 1e-9)
+            line = (f'# overhead: sampler CPU {self.cpu["sampler"]:.2f} s = '
+                    f'{self.cpu["sampler"] / wall:.2%} of one core in '
+                    f'{wall:.0f} s, probe subprocesses '
+                    f'{self.cpu["subprocesses"]:.2f} s, '
+                    f'RSS {self.rss / 2**20:.1f} MB')
+            if self.peak_rss:
+                line += f' (peak {self.peak_rss / 2**20:.1f} MB)'
+            lines.append(line)
+        for name, histogram in self.histograms.items():
+            summary = histogram.summary()
+            if not summary['count']:
+                continue
+            lines.append(f'# {name}: n={summary["count"]} '
+                         f'mean {format_ms(summary["mean"])}, '
+                         f'p99 {format_ms(summary["p99"])}, '
+                         f'max {format_ms(summary["max"])}')
+        for stats in self.workers:
+            lines.append(f'# load cpu{stats["cpu"]}: loop overhead '
+                         f'{stats["loop_overhead"]:.3%}, wake-up late mean '
+                         f'{format_ms(stats["wake_late_mean"])} max '
+                         f'{format_ms(stats["wake_late_max"])}, busy '
+                         f'overshoot mean '
+                         f'{format_ms(stats["overshoot_mean"])}')
+        return lines
+
+    def profile(self) -> dict:
+        '''Return all measurements for the detailed JSON profile'''
+        return dict(cpu=self.cpu, rss=self.rss, peak_rss=self.peak_rss,
+                    threads=self.threads,
+                    histograms={name: histogram.as_dict() for name, histogram
+                                in self.histograms.items()},
+                    workers=self.workers)
+
+    def write_profile(self, fname):
+        '''Write profile() as JSON to fname'''
+        with open(fname, 'w', encoding='utf8') as file:
+            json.dump(self.profile(), file, indent=1)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of sample ticks and concurrent probes
+
+requires Python 3.7 or later
+
+ticks() schedules samples at absolute deadlines on time.monotonic_ns, so
+sleep errors do not add up over long runs.
+
+ProbeScheduler runs the slow probes of one tick concurrently with a common
+deadline. A probe still running at the deadline is reported as missing
+(None) and is not started again before it has finished, so a hanging
+vcgencmd never delays the sample or piles up threads.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+__version__ = '0.0.2'
+
+
+def ticks(period, timeout):
+    '''Yield (scheduled time, seconds since start) at start + n * period
+
+    scheduled time is a time.monotonic() value. If a tick is missed
+    completely it is skipped, the next tick is the last deadline already
+    passed.
+    '''
+    period_ns = max(1, round(period * 1e9))
+    start = time.monotonic_ns()
+    end = start + round(timeout * 1e9)
+    index = 0
+    while True:
+        scheduled = start + index * period_ns
+        if scheduled >= end:
+            return
+        now = time.monotonic_ns()
+        if now < scheduled:
+            time.sleep((scheduled - now) / 1e9)
+            now = time.monotonic_ns()
+        yield scheduled / 1e9, (now - start) / 1e9
+        index = max(index + 1, (time.monotonic_ns() - start) // period_ns)
+
+
+class ProbeScheduler():
+    '''Run probes on a small thread pool with a deadline per tick'''
+
+    def __init__(self, probes):
+        '''probes = {name: function without arguments}'''
+        self.probes = dict(probes)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, len(self.probes)),
+                                       thread_name_prefix='probe')
+        self.pending = dict()
+
+    def run(self, deadline) -> dict:
+        '''Return {name: result} of all probes, None if missing
+
+        deadline = time.monotonic() value until results are awaited
+        '''
+        futures = dict()
+        for name, probe in self.probes.items():
+            future = self.pending.get(name)
+            if future is None or future.done():
+                future = self.pool.submit(probe)
+            futures[name] = future
+        wait(futures.values(), timeout=max(0, deadline - time.monotonic()))
+        results = dict()
+        self.pending = dict()
+        for name, future in futures.items():
+            if not future.done():
+                self.pending[name] = future
+                results[name] = None
+            elif future.exception() is not None:
+                results[name] = None
+            else:
+                results[name] = future.result()
+        return results
+
+    def missing(self) -> list:
+        '''Return names of probes which missed the last deadline'''
+        return list(self.pending)
+
+    def close(self):
+        '''Stop thread pool without waiting for pending probes'''
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Load profiles for raspiload
+
+requires Python 3.7 or later
+
+A profile is a sequence of segments, each returning the load (0..1) at a
+time relative to its own start. raspiload.load_single_cpu asks the profile
+for the load of every PWM period. Profiles are written as JSON:
+
+    {"repeat": 2,
+     "segments": [
+        {"type": "step", "duration": 30, "load": 0.5},
+        {"type": "ramp", "duration": 60, "start": 0.1, "end": 1.0},
+        {"type": "sine", "duration": 60, "mean": 0.5, "amplitude": 0.4,
+         "period": 20},
+        {"type": "square", "duration": 60, "low": 0.1, "high": 0.9,
+         "period": 10, "duty": 0.5},
+        {"type": "replay", "fname": "data/cr2020-05-02.txt",
+         "column": "load", "scale": 0.01, "speed": 1},
+        {"type": "step", "at": 600, "duration": 30, "load": 1.0}]}
+
+"at" starts a segment at an absolute time (seconds since start of the
+load, or of the pass if repeated), the gap before it is idle. "repeat"
+runs all segments again. A profile ending before the timeout of the run
+holds its last load until the timeout. A file with {"cores": {"0":
+profile, ...}} gives every core its own profile, as
+load_cpus(load_plans=...).
+"""
+import json
+import math
+import bisect
+from raspidata import read_records
+
+__version__ = '0.0.4'
+
+# rows read from a replayed text log, traces are not decimated below this
+MAX_TRACE_ROWS = 10_000_000
+
+
+class Segment():
+    '''Constant load for duration seconds'''
+    name = 'step'
+
+    def __init__(self, duration, load=0.0, at=None):
+        '''duration in seconds, load 0..1, at = absolute start or None'''
+        self.duration = float(duration)
+        self.load = float(load)
+        self.at = at
+
+    def __call__(self, t) -> float:
+        '''Return load t seconds after start of segment'''
+        return self.load
+
+    def label(self) -> str:
+        '''Return description for load reports'''
+        return f'{self.load:4.0%}'
+
+
+class Ramp(Segment):
+    '''Linear change of load from start to end'''
+    name = 'ramp'
+
+    def __init__(self, duration, start=0.0, end=1.0, at=None):
+        super().__init__(duration, start, at)
+        self.end = float(end)
+
+    def __call__(self, t):
+        if self.duration <= 0:
+            return self.end
+        return self.load + (self.end - self.load) * t / self.duration
+
+    def label(self):
+        return f'ramp {self.load:.0%}..{self.end:.0%}'
+
+
+class Sine(Segment):
+    '''Sine wave around mean load'''
+    name = 'sine'
+
+    def __init__(self, duration, mean=0.5, amplitude=0.5, period=60.0,
+                 at=None):
+        super().__init__(duration, mean, at)
+        self.amplitude = float(amplitude)
+        self.period = float(period)
+
+    def __call__(self, t):
+        return self.load + self.amplitude * math.sin(
+            2 * math.pi * t / self.period)
+
+    def label(self):
+        return f'sine {self.load:.0%}±{self.amplitude:.0%}/{self.period:g}s'
+
+
+class Square(Segment):
+    '''Square wave switching between low and high load'''
+    name = 'square'
+
+    def __init__(self, duration, low=0.0, high=1.0, period=10.0, duty=0.5,
+                 at=None):
+        super().__init__(duration, low, at)
+        self.high = float(high)
+        self.period = float(period)
+        self.duty = float(duty)
+
+    def __call__(self, t):
+        if (t % self.period) < self.duty * self.period:
+            return self.high
+        return self.load
+
+    def label(self):
+        return f'square {self.load:.0%}/{self.high:.0%}/{self.period:g}s'
+
+
+class Replay(Segment):
+    '''Load trace recorded by raspicheck, held until the next sample'''
+    name = 'replay'
+
+    def __init__(self, fname, column='load', scale=0.01, speed=1.0,
+                 duration=None, at=None):
+        '''Read column of text or binary log fname
+
+        scale converts logged values to 0..1 (load is logged in %),
+        speed > 1 replays faster.
+        '''
+        self.fname = fname
+        self.column = column
+        times, loads = read_trace(fname, column)
+        if not times:
+            raise ValueError(f'no {column!r} values in {fname}')
+        start = times[0]
+        self.times = [(t - start) / speed for t in times]
+        self.loads = [load * scale for load in loads]
+        if duration is None:
+            # the last sample holds for one mean sample interval
+            duration = self.times[-1] * len(times) / max(1, len(times) - 1)
+        super().__init__(duration, at=at)
+
+    def __call__(self, t):
+        index = bisect.bisect_right(self.times, t) - 1
+        return self.loads[max(0, index)]
+
+    def label(self):
+        return f'replay {self.column} of {self.fname}'
+
+
+SEGMENTS = {segment.name: segment for segment in (Segment, Ramp, Sine,
+                                                  Square, Replay)}
+
+
+def read_trace(fname, column='load'):
+    '''Return times and values of column in a text or binary raspi log
+
+    The log is read at full resolution up to MAX_TRACE_ROWS rows. Profiles
+    are loaded before sampling starts, numpy is not imported.
+    '''
+    if fname.endswith('.bin'):
+        _, samples = read_records(fname, MAX_TRACE_ROWS)
+    else:
+        from raspianalyse import read_log
+        _, _, samples = read_log(fname, max_rows=MAX_TRACE_ROWS)
+    if column not in samples:
+        return [], []
+    pairs = [(t, value) for t, value in zip(samples['time'],
+                                            samples[column])
+             if t == t and value == value]
+    return [t for t, _ in pairs], [value for _, value in pairs]
+
+
+class Profile():
+    '''Segments run one after the other, repeated repeat times'''
+
+    def __init__(self, segments, repeat=1):
+        '''segments = list of Segment'''
+        self.segments = list(segments)
+        self.repeat = max(1, int(repeat))
+        # (start, end, segment) of one pass
+        self.schedule = list()
+        start = 0.0
+        for segment in self.segments:
+            if segment.at is not None:
+                if segment.at < start:
+                    raise ValueError(f'segment at {segment.at} s starts '
+                                     f'before previous end {start:g} s')
+                start = float(segment.at)
+            self.schedule.append((start, start + segment.duration, segment))
+            start += segment.duration
+        self.length = start
+        self.duration = start * self.repeat
+
+    @classmethod
+    def from_plan(cls, load_plan, timeout):
+        '''Return profile of load_plan [(time_slice, loadpct), ...]
+
+        Time slices are relative and scaled to timeout.
+        '''
+        times, loads = zip(*load_plan)
+        times_sum = sum(times)
+        return cls(Segment(round(timeout * t / times_sum, 1), load)
+                   for t, load in zip(times, loads))
+
+    def steps(self, timeout=None):
+        '''Yield (start, end, segment) of all passes up to timeout
+
+        If all passes end before timeout, a last step holds the load at the
+        end of the last segment until timeout.
+        '''
+        last = 0.0
+        for index in range(self.repeat):
+            offset = index * self.length
+            for start, end, segment in self.schedule:
+                if timeout is not None and offset + start >= timeout:
+                    return
+                yield offset + start, offset + end, segment
+                last = offset + end
+        if timeout is not None and last < timeout and self.schedule:
+            segment = self.schedule[-1][2]
+            yield last, timeout, Segment(timeout - last,
+                                         segment(segment.duration))
+
+    def __call__(self, t) -> float:
+        '''Return load 0..1 at t seconds after start'''
+        if t < 0 or t >= self.duration or self.length <= 0:
+            return 0.0
+        t %= self.length
+        for start, end, segment in self.schedule:
+            if start <= t < end:
+                return max(0.0, min(1.0, segment(t - start)))
+        return 0.0
+
+
+def parse_profile(spec) -> Profile:
+    '''Return Profile of dict {"segments": [...], "repeat": n}'''
+    segments = list()
+    for item in spec['segments']:
+        item = dict(item)
+        kind = item.pop('type', 'step')
+        if kind not in SEGMENTS:
+            raise ValueError(f'unknown segment type {kind!r}, '
+                             f'use one of {list(SEGMENTS)}')
+        segments.append(SEGMENTS[kind](**item))
+    return Profile(segments, spec.get('repeat', 1))
+
+
+def load_profile(fname):
+    '''Return Profile or {core: Profile} of JSON file'''
+    with open(fname, 'r', encoding='utf8') as file:
+        spec = json.load(file)
+    if 'cores' in spec:
+        return {int(core): parse_profile(profile)
+                for core, profile in spec['cores'].items()}
+    return parse_profile(spec)
@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+"""
+Headless chart rendering of raspi logs
+
+requires Python 3.7 or later
+
+ChartRenderer draws the charts of raspianalyse.plot_pdf on a Figure with
+the Agg canvas, pyplot is never imported. The layout (gridspec, axes,
+titles, lines) is built once; every log only updates the line data with
+set_data and is saved as PDF, PNG and/or SVG. Logs with work columns also
+get the work chart of raspianalyse.plot_work as <log>_work.<format>.
+
+render_batch spreads the logs of a directory over a process pool, one
+ChartRenderer per process. A cache in the chart directory, keyed on
+(path, mtime, size, parser version), skips unchanged logs; changed logs
+are re-rendered only if a hash of their parsed data changed.
+
+As render worker (--watch or --queue) the process lowers its CPU and IO
+priority (nice 19, SCHED_IDLE, ionice idle) and renders previews of runs
+in progress and the charts of finished runs, outside the measurement.
+NumPy, matplotlib and raspianalyse are imported by the functions using
+them, so the worker imports them only after lowering its priority.
+
+Usage:
+    python3 raspirender.py data/ -o charts/ -f pdf png
+    python3 raspirender.py data/ --watch --preview 60
+    echo "final data/cr2020-05-02.txt" | python3 raspirender.py --queue
+"""
+import os
+import sys
+import json
+import time
+import queue
+from threading import Thread
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from raspidata import cpu_columns, work_columns
+
+__version__ = '0.0.4'
+
+A4PORTRAIT = (8.27, 11.69)
+FORMATS = ('pdf', 'png', 'svg')
+# processed logs of render_batch, in the chart directory
+CACHE_FNAME = '.raspirender.json'
+# seconds between previews of a run in progress
+PREVIEW_INTERVAL = 60.0
+# seconds without change after which a log counts as finished
+SETTLE_TIME = 30.0
+
+# (column, ylabel, title, drawstyle, ylim, grid position)
+LINES = [('temp', '°C', 'Temperature', 'default', (None, None), (0, 0)),
+         ('load', 'in %', 'CPU load', 'steps', (0, 105), (1, 0)),
+         ('freq', 'GHz', 'CPU Frequency', 'steps', (None, None), (4, 0)),
+         ('volt', 'Voltage', 'CPU Voltage', 'steps', (None, None), (4, 1))]
+# (column, title, grid position)
+FLAGS = [('undervoltage', 'Under-voltage detected', (0, 1)),
+         ('freq_capped', 'Arm frequency capped', (1, 1)),
+         ('throttled', 'CPU throttled', (2, 1)),
+         ('soft_temp_limit', 'Soft temperate limit active', (3, 1))]
+# (column, xlabel) of the work scatter charts
+WORK_SCATTER = [('temp', 'Temperature in °C'), ('volt', 'CPU Voltage')]
+
+
+class ChartRenderer():
+    '''Figure of plot_pdf built once and redrawn for every log'''
+
+    def __init__(self, figsize=A4PORTRAIT, dpi=100):
+        '''Build layout with empty lines'''
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        self.fig = Figure(figsize=figsize, dpi=dpi, frameon=True)
+        FigureCanvasAgg(self.fig)
+        self.title = self.fig.suptitle('', size=16, color='blue',
+                                       fontweight='bold')
+        gspec = self.fig.add_gridspec(nrows=5, ncols=2,
+                                      bottom=0.05, top=0.93,
+                                      left=0.1, right=0.95,
+                                      hspace=0.33, wspace=0.25)
+        self.axes = list()
+        # column: (axes, line, 'no data' text, fixed ylim)
+        self.lines = dict()
+        for name, label, title, drawstyle, ylim, pos in LINES:
+            ax = self.add_axes(gspec[pos], title, label)
+            line, = ax.plot([], [], lw=3, drawstyle=drawstyle)
+            ax.set_ylim(ylim)
+            self.lines[name] = (ax, line, self.no_data(ax, title), ylim)
+        # column: (axes, 'no data' text), fills are replaced per log
+        self.flags = dict()
+        for name, title, pos in FLAGS:
+            ax = self.add_axes(gspec[pos], title)
+            ax.set_ylim((0, 1))
+            ax.tick_params(axis='y', labelleft=False)
+            self.flags[name] = (ax, self.no_data(ax, f'\n{title}'))
+        self.stack_ax = self.add_axes(gspec[2:4, 0], 'all CPUs load',
+                                      'cumulative CPU load in %')
+        # artists drawn per log and removed before the next one
+        self.artists = list()
+        # work chart, built on first use, see work_chart
+        self.work = None
+
+    def add_axes(self, spec, title, ylabel=''):
+        '''Return new axes with common formatting'''
+        ax = self.fig.add_subplot(spec)
+        ax.grid(True)
+        ax.set_title(title, loc='center', fontweight='bold')
+        ax.set_ylabel(ylabel, fontweight='bold', fontsize=11)
+        self.axes.append(ax)
+        return ax
+
+    @staticmethod
+    def no_data(ax, title):
+        '''Return hidden 'no data' textbox of axes'''
+        from raspianalyse import add_textbox
+        add_textbox(ax, f'no data for {title!r}')
+        text = ax.texts[-1]
+        text.set_visible(False)
+        return text
+
+    def update(self, data, title=''):
+        '''Show columns of data {name: numpy array}'''
+        import numpy as np
+        for artist in self.artists:
+            artist.remove()
+        self.artists = list()
+        self.title.set_text(title)
+        xvalues = data['time']
+        for name, (ax, line, text, ylim) in self.lines.items():
+            values = data.get(name)
+            text.set_visible(values is None)
+            ax.tick_params(axis='y', labelleft=values is not None)
+            if values is None:
+                line.set_data([], [])
+                continue
+            line.set_data(xvalues, values)
+            if ylim == (None, None):
+                ax.relim()
+                ax.autoscale_view(scalex=False)
+        for name, (ax, text) in self.flags.items():
+            values = data.get(name)
+            text.set_visible(values is None)
+            if values is not None:
+                self.artists.append(ax.fill_between(
+                    xvalues, values, step='mid', alpha=0.3, color='red'))
+        cpus = [data[name] for name in cpu_columns(data)]
+        if cpus:
+            self.artists.extend(self.stack_ax.stackplot(xvalues, *cpus,
+                                                        alpha=.6))
+            self.stack_ax.set_ylim(0, 100 * len(cpus) * 1.05)
+        xmax = np.nanmax(xvalues) if len(xvalues) else 1
+        for ax in self.axes:
+            ax.set_xlim((0, xmax or 1))
+
+    def work_chart(self) -> dict:
+        '''Return figure, title, axes and line of the work chart
+
+        Same charts as raspianalyse.plot_work, built on first use.
+        '''
+        if self.work is None:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            fig = Figure(figsize=self.fig.get_size_inches(),
+                         dpi=self.fig.dpi, frameon=True)
+            FigureCanvasAgg(fig)
+            title = fig.suptitle('', size=16, color='blue',
+                                 fontweight='bold')
+            axes = fig.subplots(3, 1)
+            line, = axes[0].plot([], [], lw=2)
+            axes[0].set_xlabel('seconds')
+            # column: (axes, 'no data' text)
+            scatters = dict()
+            for ax, (name, label) in zip(axes[1:], WORK_SCATTER):
+                ax.set_xlabel(label)
+                scatters[name] = (ax, self.no_data(ax, label))
+            for ax in axes:
+                ax.set_ylabel('work/s of all workers')
+                ax.grid(True)
+            self.work = dict(fig=fig, title=title, axes=axes, line=line,
+                             scatters=scatters, artists=list())
+        return self.work
+
+    @staticmethod
+    def set_limits(ax, xvalues, yvalues):
+        '''Fit axes limits to the finite values with 5% margins'''
+        import numpy as np
+        for values, setter in ((xvalues, ax.set_xlim),
+                               (yvalues, ax.set_ylim)):
+            values = values[np.isfinite(values)]
+            if len(values):
+                low, high = values.min(), values.max()
+                margin = (high - low) * 0.05 or abs(high) * 0.05 or 1
+                setter((low - margin, high + margin))
+
+    def update_work(self, data, title='') -> bool:
+        '''Show total work per second of data, False if it has none'''
+        names = work_columns(data)
+        if not names:
+            return False
+        import numpy as np
+        work = self.work_chart()
+        for artist in work['artists']:
+            artist.remove()
+        work['artists'] = list()
+        total = np.nansum([data[name] for name in names], axis=0)
+        work['title'].set_text(f'{title}\nwork per second')
+        work['line'].set_data(data['time'], total)
+        self.set_limits(work['axes'][0], data['time'], total)
+        for name, (ax, text) in work['scatters'].items():
+            values = data.get(name)
+            text.set_visible(values is None)
+            if values is not None:
+                work['artists'].append(ax.scatter(values, total, s=4,
+                                                  alpha=0.5))
+                self.set_limits(ax, values, total)
+        return True
+
+    def save(self, base, formats=('pdf',), fig=None) -> list:
+        '''Save figure as base.<format> for all formats, return names'''
+        if fig is None:
+            fig = self.fig
+        fnames = list()
+        for fmt in formats:
+            fname = f'{base}.{fmt}'
+            fig.savefig(fname, format=fmt)
+            fnames.append(fname)
+        return fnames
+
+    def render(self, fname, datapath='', chartpath='', formats=('pdf',)):
+        '''Read log fname and save its charts in chartpath'''
+        title, base, data = read_chart_data(fname, datapath)
+        return self.draw(title, base, data, chartpath, formats)
+
+    def draw(self, title, base, data, chartpath='', formats=('pdf',)):
+        '''Save charts of data as chartpath/base.<format>
+
+        and the work chart as chartpath/base_work.<format> if data has
+        work columns.
+        '''
+        self.update(data, title)
+        if chartpath:
+            os.makedirs(chartpath, exist_ok=True)
+        base = os.path.join(chartpath, base)
+        charts = self.save(base, formats)
+        if self.update_work(data, title):
+            charts += self.save(f'{base}_work', formats, self.work['fig'])
+        return charts
+
+
+def read_chart_data(fname, datapath=''):
+    '''Return title, chart base name and columns as arrays of log fname'''
+    from raspianalyse import read_any, as_arrays
+    title, _, samples = read_any(fname, datapath)
+    data = as_arrays(samples)
+    if 'time' not in data:
+        raise ValueError(f'no samples in {fname}')
+    base = os.path.splitext(os.path.basename(fname))[0]
+    return title, base, data
+
+
+def data_digest(title, data) -> str:
+    '''Return hash of title and columns'''
+    import numpy as np
+    digest = hashlib.blake2b(title.encode('utf8'), digest_size=16)
+    for name in sorted(data):
+        digest.update(name.encode('utf8'))
+        digest.update(np.ascontiguousarray(data[name]).tobytes())
+    return digest.hexdigest()
+
+
+def file_key(fname) -> list:
+    '''Return cache key (path, mtime, size, parser version) of fname'''
+    from raspianalyse import __version__ as parser_version
+    stat = os.stat(fname)
+    return [os.path.abspath(fname), stat.st_mtime_ns, stat.st_size,
+            parser_version]
+
+
+# ChartRenderer of a render_batch worker process
+renderer = None
+
+
+def chart_names(chartpath, base, formats, work=False) -> list:
+    '''Return charts ChartRenderer.draw saves of log base
+
+    work = the log has work columns, its work charts are included
+    '''
+    base = os.path.join(chartpath, base)
+    bases = [base, f'{base}_work'] if work else [base]
+    return [f'{name}.{fmt}' for name in bases for fmt in formats]
+
+
+def render_job(fname, datapath, chartpath, formats, digest=None):
+    '''Render log in worker, return (fname, digest, charts, drawn, error)
+
+    Nothing is drawn if the parsed data still has the given digest and
+    its charts exist.
+    '''
+    global renderer
+    try:
+        title, base, data = read_chart_data(fname, datapath)
+        new_digest = data_digest(title, data)
+        charts = chart_names(chartpath, base, formats,
+                             bool(work_columns(data)))
+        if new_digest == digest and all(map(os.path.exists, charts)):
+            return fname, digest, charts, False, None
+        if renderer is None:
+            renderer = ChartRenderer()
+        charts = renderer.draw(title, base, data, chartpath, formats)
+        return fname, new_digest, charts, True, None
+    except (KeyError, ValueError, OSError) as err:
+        return fname, None, None, False, repr(err)
+
+
+def load_cache(fname) -> dict:
+    '''Return {log file: entry} of cache file or empty dict'''
+    try:
+        with open(fname, 'r', encoding='utf8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_cache(fname, cache):
+    '''Write cache atomically'''
+    tmp = fname + '.tmp'
+    with open(tmp, 'w', encoding='utf8') as file:
+        json.dump(cache, file, indent=1)
+    os.replace(tmp, fname)
+
+
+def render_batch(datapath='data/', chartpath='charts/', formats=('pdf',),
+                 processes=None, force=False, settle=0) -> dict:
+    '''Render charts of all logs in datapath over a process pool
+
+    Logs with the cached (path, mtime, size, parser version) and existing
+    charts are skipped, as are logs changed within the last settle
+    seconds. Return counts of rendered, unchanged (parsed data
+    unchanged), skipped and failed logs.
+    '''
+    os.makedirs(chartpath, exist_ok=True)
+    cache_fname = os.path.join(chartpath, CACHE_FNAME)
+    cache = dict() if force else load_cache(cache_fname)
+    counts = dict(rendered=0, unchanged=0, skipped=0, failed=0)
+    jobs = dict()
+    for fname in log_files(datapath):
+        key = file_key(os.path.join(datapath, fname))
+        if settle and time.time() - key[1] / 1e9 < settle:
+            continue
+        entry = cache.get(fname, dict())
+        cached = entry.get('charts', ())
+        # a cached work chart in any format: the log has work columns
+        base = os.path.splitext(fname)[0]
+        work_base = os.path.join(chartpath, f'{base}_work.')
+        charts = chart_names(chartpath, base, formats,
+                             any(chart.startswith(work_base)
+                                 for chart in cached))
+        if (entry.get('key') == key and set(charts) <= set(cached)
+                and all(map(os.path.exists, charts))):
+            counts['skipped'] += 1
+            continue
+        jobs[fname] = key, entry.get('digest')
+    if jobs:
+        with ProcessPoolExecutor(processes) as pool:
+            futures = [pool.submit(render_job, fname, datapath, chartpath,
+                                   formats, digest)
+                       for fname, (_, digest) in jobs.items()]
+            for future in futures:
+                fname, digest, charts, drawn, error = future.result()
+                if error is not None:
+                    print(f'Error for {fname}: {error}')
+                    counts['failed'] += 1
+                    cache.pop(fname, None)
+                    continue
+                if drawn:
+                    counts['rendered'] += 1
+                    print(', '.join(charts))
+                else:
+                    counts['unchanged'] += 1
+                cache[fname] = dict(key=jobs[fname][0], digest=digest,
+                                    charts=charts)
+        save_cache(cache_fname, cache)
+    return counts
+
+
+def log_files(datapath):
+    '''Return text and binary raspi logs in datapath'''
+    return sorted(fname for fname in os.listdir(datapath)
+                  if fname.startswith('cr')
+                  and fname.endswith(('.txt', '.bin')))
+
+
+def lower_priority(cores=None):
+    '''Give the calling process the lowest CPU and IO priority
+
+    cores = CPUs the process may run on, None = all
+    '''
+    os.nice(19)
+    if hasattr(os, 'SCHED_IDLE'):
+        try:
+            os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+        except OSError:
+            pass
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, set(cores))
+    try:
+        import psutil
+        psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (ImportError, AttributeError, OSError):
+        pass
+
+
+def preview_base(fname) -> str:
+    '''Return chart base name of preview of log fname'''
+    return os.path.splitext(os.path.basename(fname))[0] + '_preview'
+
+
+def render_log(renderer, fname, chartpath, formats, base=None):
+    '''Render log fname, print charts or error'''
+    try:
+        title, log_base, data = read_chart_data(fname)
+        charts = renderer.draw(title, base or log_base, data, chartpath,
+                               formats)
+    except (KeyError, ValueError, OSError) as err:
+        print(f'Error for {fname}: {err!r}')
+    else:
+        print(', '.join(charts), flush=True)
+
+
+def serve_queue(lines, chartpath='charts/', formats=('pdf',),
+                preview=PREVIEW_INTERVAL):
+    '''Render jobs read from lines until they end
+
+    'follow <log>' renders a PNG preview of a run in progress every
+    preview seconds, 'final <log>' renders the charts of the finished
+    run. Followed logs are rendered as final when lines end.
+    '''
+    jobs = queue.Queue()
+
+    def read_jobs():
+        for line in lines:
+            jobs.put(line)
+        jobs.put(None)
+
+    Thread(target=read_jobs, daemon=True).start()
+    renderer = ChartRenderer()
+    # log: time.monotonic() of next preview
+    following = dict()
+    while True:
+        timeout = None
+        if following:
+            timeout = max(0, min(following.values()) - time.monotonic())
+        try:
+            line = jobs.get(timeout=timeout)
+        except queue.Empty:
+            line = ''
+        if line is None:
+            break
+        cmd, _, fname = line.strip().partition(' ')
+        if cmd == 'follow':
+            following[fname] = time.monotonic() + preview
+        elif cmd == 'final':
+            following.pop(fname, None)
+            render_log(renderer, fname, chartpath, formats)
+        elif cmd:
+            print(f'Unknown job {line.strip()!r}')
+        now = time.monotonic()
+        for fname, due in list(following.items()):
+            if due <= now:
+                render_log(renderer, fname, chartpath, ('png',),
+                           preview_base(fname))
+                following[fname] = now + preview
+    for fname in following:
+        render_log(renderer, fname, chartpath, formats)
+
+
+def watch(datapath='data/', chartpath='charts/', formats=('pdf',),
+          preview=PREVIEW_INTERVAL, settle=SETTLE_TIME, interval=10.0):
+    '''Render logs in datapath as they appear, until interrupted
+
+    Logs unchanged for settle seconds are rendered once (render_batch
+    cache), logs still growing get a PNG preview every preview seconds.
+    '''
+    renderer = ChartRenderer()
+    previews = dict()
+    while True:
+        render_batch(datapath, chartpath, formats, processes=1,
+                     settle=settle)
+        now = time.time()
+        for fname in log_files(datapath):
+            ffname = os.path.join(datapath, fname)
+            if (now - os.path.getmtime(ffname) < settle
+                    and previews.get(fname, 0) + preview <= now):
+                render_log(renderer, ffname, chartpath, ('png',),
+                           preview_base(fname))
+                previews[fname] = now
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Render charts of raspi logs without pyplot')
+    parser.add_argument('datapath', nargs='?', default='data/',
+                        help='directory of cr*.txt and cr*.bin logs')
+    parser.add_argument('-o', '--chartpath', default='charts/', metavar='',
+                        help='directory of charts')
+    parser.add_argument('-f', '--formats', nargs='+', default=['pdf'],
+                        choices=FORMATS, help='chart formats')
+    parser.add_argument('-j', '--processes', type=int, metavar='',
+                        help='worker processes, default all CPUs')
+    parser.add_argument('--force', action='store_true',
+                        help='ignore cache and render all logs')
+    parser.add_argument('--watch', action='store_true',
+                        help='low priority worker rendering new logs and '
+                             'previews of runs in progress')
+    parser.add_argument('--queue', action='store_true',
+                        help='low priority worker rendering jobs from '
+                             'stdin: follow <log> or final <log>')
+    parser.add_argument('--preview', type=float, default=PREVIEW_INTERVAL,
+                        metavar='', help='seconds between previews')
+    parser.add_argument('--cores', type=int, nargs='+', metavar='',
+                        help='CPUs the worker may run on')
+    args = parser.parse_args()
+    if args.watch or args.queue:
+        lower_priority(args.cores)
+    if args.queue:
+        serve_queue(sys.stdin, args.chartpath, args.formats, args.preview)
+    elif args.watch:
+        try:
+            watch(args.datapath, args.chartpath, args.formats, args.preview)
+        except KeyboardInterrupt:
+            pass
+    else:
+        counts = render_batch(args.datapath, args.chartpath, args.formats,
+                              args.processes, args.force)
+        print(', '.join(f'{count} {name}'
+                        for name, count in counts.items()))
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Statistics of raspi logs for ranking power supplies, cables and boards
+
+requires Python 3.7 or later
+
+summarize() works on the columns of one log as NumPy arrays, without a
+Python loop over samples:
+- % of time under-voltage, frequency capped, throttled, soft temp limit
+- seconds from the start of each load step to the first throttling
+- temperature slope in °C/min per load level
+- min/mean/p99 of voltage and frequency
+
+Usage:
+    python3 raspistats.py data/ -f csv -o stats.csv --sort pct_undervoltage
+"""
+import os
+import csv
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from raspianalyse import read_any, as_arrays
+
+__version__ = '0.0.1'
+
+# load levels in % the load column is rounded to
+LOAD_STEP = 10
+# samples a load level must last to count as a load step
+MIN_STEP_SAMPLES = 3
+# flags counted as throttling for time_to_throttle
+THROTTLE_FLAGS = ('throttled', 'freq_capped', 'soft_temp_limit')
+# rows read from a log, logs are not decimated below this
+MAX_ROWS = 10_000_000
+
+
+def sample_durations(times):
+    '''Return seconds each sample stands for, the last one the median'''
+    if len(times) < 2:
+        return np.ones(len(times))
+    dt = np.diff(times)
+    return np.append(dt, np.median(dt))
+
+
+def flag_percent(values, dt) -> float:
+    '''Return % of time a 0/1 column was 1, NaN samples left out'''
+    valid = ~np.isnan(values)
+    total = dt[valid].sum()
+    if not total:
+        return None
+    return float(100 * (dt[valid] * values[valid]).sum() / total)
+
+
+def load_steps(load, step=LOAD_STEP, min_samples=MIN_STEP_SAMPLES):
+    '''Return start indexes and levels of load steps
+
+    The load is rounded to step %, levels lasting less than min_samples
+    samples are merged into the previous step.
+    '''
+    level = np.round(np.nan_to_num(load, nan=0) / step) * step
+    starts = np.flatnonzero(np.diff(level)) + 1
+    starts = np.insert(starts, 0, 0)
+    lengths = np.diff(np.append(starts, len(level)))
+    keep = lengths >= min_samples
+    keep[0] = True
+    starts = starts[keep]
+    levels = level[starts]
+    # neighbours with the same level after dropping short runs
+    same = np.append(True, levels[1:] != levels[:-1])
+    return starts[same], levels[same]
+
+
+def time_to_throttle(times, throttling, starts, levels) -> list:
+    '''Return [{start, load, seconds}] of every load step
+
+    seconds from the start of the step to the first throttled sample of
+    the step, None if it was never throttled.
+    '''
+    ends = np.append(starts[1:], len(times))
+    hits = np.flatnonzero(throttling)
+    # first throttled sample at or after every step start
+    first = np.searchsorted(hits, starts)
+    steps = list()
+    for start, end, level, index in zip(starts, ends, levels, first):
+        seconds = None
+        if index < len(hits) and hits[index] < end:
+            seconds = float(times[hits[index]] - times[start])
+        steps.append(dict(start=float(times[start]), load=float(level),
+                          seconds=seconds))
+    return steps
+
+
+def temp_slopes(times, temp, starts, levels) -> dict:
+    '''Return {load level: temperature slope in °C/min}
+
+    Least squares slope of every step from sums per step (reduceat),
+    steps of the same level are weighted by their number of samples.
+    '''
+    valid = ~np.isnan(temp)
+    x = np.where(valid, times / 60, 0)
+    y = np.where(valid, temp, 0)
+    n = np.add.reduceat(valid.astype(float), starts)
+    sx = np.add.reduceat(x, starts)
+    sy = np.add.reduceat(y, starts)
+    sxx = np.add.reduceat(x * x, starts)
+    sxy = np.add.reduceat(x * y, starts)
+    denom = n * sxx - sx * sx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = np.where((n >= 2) & (denom > 0),
+                          (n * sxy - sx * sy) / denom, np.nan)
+    result = dict()
+    for level in np.unique(levels):
+        mask = (levels == level) & ~np.isnan(slopes)
+        if mask.any():
+            result[f'{level:.0f}'] = float(
+                np.average(slopes[mask], weights=n[mask]))
+    return result
+
+
+def describe(values) -> dict:
+    '''Return min, mean and 99th percentile of column'''
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return dict(min=None, mean=None, p99=None)
+    return dict(min=float(values.min()), mean=float(values.mean()),
+                p99=float(np.percentile(values, 99)))
+
+
+def summarize(data) -> dict:
+    '''Return statistics of columns {name: numpy array} of one log'''
+    times = data['time']
+    dt = sample_durations(times)
+    stats = dict(samples=len(times),
+                 duration=float(times[-1] - times[0]) if len(times) else 0)
+    for name in ('undervoltage', 'freq_capped', 'throttled',
+                 'soft_temp_limit'):
+        stats[f'pct_{name}'] = (flag_percent(data[name], dt)
+                                if name in data else None)
+    if 'load' in data and len(times):
+        starts, levels = load_steps(data['load'])
+        flags = [np.nan_to_num(data[name]) > 0 for name in THROTTLE_FLAGS
+                 if name in data]
+        if flags:
+            stats['time_to_throttle'] = time_to_throttle(
+                times, np.logical_or.reduce(flags), starts, levels)
+        if 'temp' in data:
+            stats['temp_slope'] = temp_slopes(times, data['temp'], starts,
+                                              levels)
+    for name in ('volt', 'freq', 'temp'):
+        if name in data:
+            for key, value in describe(data[name]).items():
+                stats[f'{name}_{key}'] = value
+    return stats
+
+
+def summarize_log(fname, path='') -> dict:
+    '''Return statistics of log fname, error if it can not be read'''
+    try:
+        title, _, samples = read_any(fname, path, max_rows=MAX_ROWS)
+        data = as_arrays(samples)
+        if 'time' not in data:
+            raise ValueError('no samples')
+        stats = summarize(data)
+    except (KeyError, ValueError, OSError) as err:
+        return dict(fname=fname, error=repr(err))
+    return dict(fname=fname, title=title, **stats)
+
+
+def summarize_dir(datapath='data/', processes=None) -> list:
+    '''Return statistics of all logs in datapath, read in parallel'''
+    fnames = sorted(fname for fname in os.listdir(datapath)
+                    if fname.startswith('cr')
+                    and fname.endswith(('.txt', '.bin')))
+    paths = [datapath] * len(fnames)
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(summarize_log, fnames, paths, chunksize=16))
+
+
+def flat_row(stats) -> dict:
+    '''Return statistics with nested values flattened for CSV'''
+    row = {key: value for key, value in stats.items()
+           if not isinstance(value, (list, dict))}
+    steps = stats.get('time_to_throttle', [])
+    throttled = [step['seconds'] for step in steps
+                 if step['seconds'] is not None]
+    row['first_throttle'] = min(throttled) if throttled else None
+    row['time_to_throttle'] = ' '.join(
+        f'{step["load"]:.0f}%:'
+        + ('-' if step['seconds'] is None else f'{step["seconds"]:.1f}')
+        for step in steps)
+    for level, slope in stats.get('temp_slope', {}).items():
+        row[f'temp_slope_{level}'] = slope
+    return row
+
+
+def write_csv(rows, file):
+    '''Write flattened statistics as CSV'''
+    rows = [flat_row(stats) for stats in rows]
+    names = list()
+    for row in rows:
+        names.extend(name for name in row if name not in names)
+    writer = csv.DictWriter(file, names)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def sort_key(name):
+    '''Return key sorting statistics by name descending, None last'''
+    def key(stats):
+        value = stats.get(name)
+        return (value is not None, value if value is not None else 0)
+    return key
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Statistics of raspi logs as JSON or CSV')
+    parser.add_argument('datapath', nargs='?', default='data/',
+                        help='directory of cr*.txt and cr*.bin logs')
+    parser.add_argument('-f', '--format', default='json',
+                        choices=['json', 'csv'], help='output format')
+    parser.add_argument('-o', '--output', metavar='',
+                        help='output file, default stdout')
+    parser.add_argument('-s', '--sort', metavar='',
+                        help='sort logs by this value, largest first, '
+                             'e.g. pct_undervoltage')
+    parser.add_argument('-j', '--processes', type=int, metavar='',
+                        help='worker processes, default all CPUs')
+    args = parser.parse_args()
+    results = summarize_dir(args.datapath, args.processes)
+    if args.sort:
+        results.sort(key=sort_key(args.sort), reverse=True)
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, 'w', encoding='utf8', newline='')
+    try:
+        if args.format == 'csv':
+            write_csv(results, out)
+        else:
+            json.dump(results, out, indent=1)
+    finally:
+        if args.output:
+            out.close()
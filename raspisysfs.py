@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Low overhead sampler reading sysfs and procfs directly
+
+requires Python 3.7 or later
+
+All files are opened once and re-read with os.pread on every tick, no
+subprocess is started for CPU data. Throttled state and core voltage come
+from one batched mailbox request (/dev/vcio, as used by vcmailbox) or, if
+that is not available, from one persistent shell running both vcgencmd
+commands per tick.
+"""
+import os
+import re
+import glob
+import fcntl
+import select
+import struct
+import subprocess
+from array import array
+
+__version__ = '0.0.3'
+
+THERMAL = 'sys/class/thermal/thermal_zone0/temp'
+SCALING_FREQ = 'sys/devices/system/cpu/cpu*/cpufreq/scaling_cur_freq'
+PROC_STAT = 'proc/stat'
+THROTTLED = 'sys/devices/platform/soc/soc:firmware/get_throttled'
+VCIO = 'dev/vcio'
+
+# _IOWR(100, 0, char *) of the vcio driver
+IOCTL_MBOX_PROPERTY = (3 << 30) | (struct.calcsize('P') << 16) | (100 << 8)
+TAG_GET_VOLTAGE = 0x00030003
+TAG_GET_THROTTLED = 0x00030046
+VOLTAGE_CORE = 1
+MBOX_SUCCESS = 0x80000000
+
+
+def cpu_number(fname) -> int:
+    '''Return CPU number of .../cpu<n>/cpufreq/... path'''
+    return int(re.search(r'cpu(\d+)/cpufreq', fname).group(1))
+
+
+def pread_text(fd, size=4096) -> str:
+    '''Return content of open file from offset 0'''
+    return os.pread(fd, size, 0).decode('ascii', 'replace')
+
+
+class Mailbox():
+    '''Batched property request to the VideoCore firmware'''
+
+    def __init__(self, fname='/dev/vcio'):
+        '''Open mailbox device, raise OSError if it does not answer'''
+        self.fd = os.open(fname, os.O_RDWR)
+        try:
+            self.read()
+        except OSError:
+            self.close()
+            raise
+
+    def read(self):
+        '''Return (throttled, core voltage in V) of one request'''
+        # size, request code, tag, value size, request size, values ...
+        buf = array('I', [0, 0,
+                          TAG_GET_THROTTLED, 4, 0, 0,
+                          TAG_GET_VOLTAGE, 8, 0, VOLTAGE_CORE, 0,
+                          0])
+        buf[0] = len(buf) * buf.itemsize
+        fcntl.ioctl(self.fd, IOCTL_MBOX_PROPERTY, buf, True)
+        if buf[1] != MBOX_SUCCESS:
+            return None, None
+        return buf[5], buf[10] / 1e6
+
+    def close(self):
+        '''Close mailbox device'''
+        os.close(self.fd)
+
+
+class VcgencmdBatch():
+    '''One persistent shell running all vcgencmd commands of a tick
+
+    Every batch ends with its own numbered end marker, output of batches
+    that timed out is dropped when it arrives later.
+    '''
+    end = '__raspi_end__'
+
+    def __init__(self, cmds=('get_throttled', 'measure_volts core'),
+                 timeout=0.3):
+        '''Start shell'''
+        self.cmds = cmds
+        self.timeout = timeout
+        self.script = '; '.join(f'vcgencmd {cmd} 2>&1' for cmd in cmds)
+        self.batch = 0
+        self.proc = subprocess.Popen(['sh'], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+        self.rest = b''
+
+    def read_lines(self) -> list:
+        '''Return output lines of one batch, empty list after timeout'''
+        self.batch += 1
+        end = f'{self.end} {self.batch}\n'.encode()
+        try:
+            self.proc.stdin.write(f'{self.script}; echo {self.end} '
+                                  f'{self.batch}\n'.encode())
+            self.proc.stdin.flush()
+        except OSError:
+            return []
+        fd = self.proc.stdout.fileno()
+        data = self.rest
+        while end not in data:
+            ready, _, _ = select.select([fd], [], [], self.timeout)
+            chunk = os.read(fd, 4096) if ready else b''
+            if not chunk:
+                self.rest = data
+                return []
+            data += chunk
+        lines, _, self.rest = data.partition(end)
+        # drop output up to the end marker of an older batch
+        _, marker, lines = lines.rpartition(self.end.encode())
+        if marker:
+            lines = lines.partition(b'\n')[2]
+        return lines.decode().splitlines()
+
+    def read(self):
+        '''Return (throttled, core voltage in V), None if not available'''
+        results = dict()
+        for line in self.read_lines():
+            key, sep, value = line.partition('=')
+            if sep and 'error' not in line:
+                results[key.strip()] = value.strip()
+        throttled, voltage = results.get('throttled'), results.get('volt')
+        try:
+            throttled = int(throttled, 0) if throttled else None
+            voltage = float(voltage[:-1]) if voltage else None
+        except ValueError:
+            return None, None
+        return throttled, voltage
+
+    def close(self):
+        '''Stop shell'''
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+
+
+class SysfsSampler():
+    '''Read CPU metrics through file descriptors kept open'''
+
+    def __init__(self, root='/', vcgencmd=True):
+        '''Open sysfs and procfs files below root
+
+        vcgencmd = use VcgencmdBatch if the mailbox is not available
+        '''
+        self.root = root
+        self.fds = list()
+        self.temp_fd = self.open(THERMAL)
+        freq_files = sorted(glob.glob(os.path.join(root, SCALING_FREQ)),
+                            key=cpu_number)
+        self.freq_fds = [self.open(fname) for fname in freq_files]
+        self.stat_fd = self.open(PROC_STAT)
+        self.throttled_fd = self.open(THROTTLED)
+        self.vc = None
+        try:
+            self.vc = Mailbox(os.path.join(root, VCIO))
+        except OSError:
+            if vcgencmd:
+                self.vc = VcgencmdBatch()
+        self.last_stat = self.read_stat()
+
+    def open(self, fname):
+        '''Return fd of file below root or None'''
+        try:
+            fd = os.open(os.path.join(self.root, fname), os.O_RDONLY)
+        except OSError:
+            return None
+        self.fds.append(fd)
+        return fd
+
+    def read_temperature(self):
+        '''Return temperature in °C or None'''
+        if self.temp_fd is None:
+            return None
+        return int(pread_text(self.temp_fd)) / 1000
+
+    def read_frequency(self):
+        '''Return average current frequency of all CPUs in GHz or None'''
+        if not self.freq_fds:
+            return None
+        freqs = [int(pread_text(fd)) for fd in self.freq_fds]
+        return sum(freqs) / len(freqs) / 1e6
+
+    def read_stat(self) -> list:
+        '''Return (busy, total) jiffies of all CPUs and of each CPU'''
+        stats = list()
+        for line in pread_text(self.stat_fd, 65536).splitlines():
+            if not line.startswith('cpu'):
+                break
+            values = [int(v) for v in line.split()[1:9]]
+            idle = values[3] + values[4]
+            total = sum(values)
+            stats.append((total - idle, total))
+        return stats
+
+    def read_cpu_loads(self):
+        '''Return average load and list of CPU loads in % since last call'''
+        stats = self.read_stat()
+        loads = list()
+        for (busy, total), (last_busy, last_total) in zip(stats,
+                                                          self.last_stat):
+            delta = total - last_total
+            loads.append(100 * (busy - last_busy) / delta if delta else 0.0)
+        self.last_stat = stats
+        return loads[0], loads[1:]
+
+    def read_vc(self):
+        '''Return (throttled, core voltage in V), None if not available'''
+        throttled, voltage = None, None
+        if self.vc is not None:
+            throttled, voltage = self.vc.read()
+        if throttled is None and self.throttled_fd is not None:
+            throttled = int(pread_text(self.throttled_fd), 16)
+        return throttled, voltage
+
+    def read_sample(self):
+        '''Return throttled, temp, voltage, freq, load, loads'''
+        throttled, voltage = self.read_vc()
+        load, loads = self.read_cpu_loads()
+        return (throttled, self.read_temperature(), voltage,
+                self.read_frequency(), load, loads)
+
+    def close(self):
+        '''Close all files'''
+        if self.vc is not None:
+            self.vc.close()
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = list()
@@ -1,29 +1,75 @@
 # -*- coding: utf-8 -*-
 """
 Print all py source codes and versions
+
+The tree is walked with os.scandir, ignored directories (.git,
+node_modules, data, ...) are not entered. Only the first HEADER_BYTES of
+every file are read and searched with a bytes regex, files are read on a
+thread pool. Versions are cached in CACHE_FNAME keyed on (mtime, size),
+repeated runs read changed files only.
+
+Usage:
+    python3 v.py
+    python3 v.py ../deploy -i build -j 16
 """
 
 import os
 import re
+import json
+import argparse
+from time import perf_counter
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-__version__ = '1.0.21'
+__version__ = '1.1.0'
 
-re_vnr = re.compile('(\d{1,3}\.\d{1,3}\.\d{1,3})')
-re_version = re.compile('(?i)version')
-re_ftype = re.compile('(\.\w+)$')
+re_vnr = re.compile(rb'(\d{1,3}\.\d{1,3}\.\d{1,3})')
+# whole lines containing version
+re_version = re.compile(rb'(?im)^.*version.*$')
+re_ftype = re.compile(r'(\.\w+)$')
 
 include_ftypes = ['.py', '.json', '.html', '.sh']
+# directories not entered, more with --ignore
+ignore_dirs = {'.git', '.hg', '.svn', 'node_modules', '__pycache__',
+               '.venv', 'venv', '.tox', '.nox', '.mypy_cache',
+               '.pytest_cache', '.ruff_cache', 'data'}
+
+# bytes read from the start of every file
+HEADER_BYTES = 64 * 1024
+# cache of versions in the scanned directory
+CACHE_FNAME = '.v_cache.json'
+# cached versions of other scanner versions are not used
+CACHE_VERSION = 1
+
+
+def scan_tree(path, ignore=ignore_dirs, ftypes=None):
+    '''Yield (path, stat) of files, ignored directories are not entered
+
+    ftypes = file types yielded, all if None
+    '''
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in ignore:
+                                stack.append(entry.path)
+                        elif entry.is_file() and (
+                                ftypes is None
+                                or get_ftype(entry.name) in ftypes):
+                            yield entry.path, entry.stat()
+                    except OSError:
+                        continue
+        except OSError:
+            continue
 
 
-def get_allfiles(path, extension=''):
+def get_allfiles(path, extension='', ignore=ignore_dirs):
     '''get all files'''
-    allfiles = list()
-    for dirpath, dirnames, filenames in os.walk(path):
-        files = [file for file in filenames if file.endswith(extension)]
-        allfiles.extend([os.path.join(dirpath, file) for file in files])
-    allfiles.sort()
-    return allfiles
+    return sorted(fname for fname, _ in scan_tree(path, ignore)
+                  if fname.endswith(extension))
 
 
 def get_ftype(fname):
@@ -32,38 +78,116 @@ def get_ftype(fname):
         return re.search(re_ftype, fname).group()
     except AttributeError:
         return ''
-    return
+
+
+def read_version(ffname, size=HEADER_BYTES):
+    '''Return version of file header, 'Missing' or None if not UTF-8
+
+    The first line containing 'version' and a version number counts.
+    '''
+    with open(ffname, 'rb') as file:
+        head = file.read(size)
+    end = len(head)
+    if end == size:
+        # do not decode a line cut at the end of the header
+        end = head.rfind(b'\n') + 1
+    for line in re_version.finditer(head, 0, end):
+        match = re_vnr.search(line.group())
+        if match:
+            end = line.end()
+            break
+    else:
+        match = None
+    try:
+        head[:end].decode('utf8')
+    except UnicodeDecodeError:
+        return None
+    return match.group().decode('ascii') if match else 'Missing'
 
 
 def check_file(ffname) -> str:
     '''Open file and read version'''
-    txt, res = None, None
-    with open(ffname, 'rb') as file:
-        for line in file:
-            try:
-                txt = line.decode('utf8').lower()
-            except UnicodeDecodeError:
-                return ffname, None
-            if re.search(re_version, txt):
-                try:
-                    res = re.search(re_vnr, txt).group()
-                except AttributeError:
-                    pass
-                else:
-                    break
-    return res, get_ftype(ffname)
+    try:
+        return read_version(ffname), get_ftype(ffname)
+    except OSError:
+        return None, get_ftype(ffname)
+
+
+def load_cache(fname) -> dict:
+    '''Return {file: [mtime, size, version]} of cache file or empty dict'''
+    try:
+        with open(fname, 'r', encoding='utf8') as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return dict()
+    if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+        return dict()
+    return cache.get('files', dict())
+
+
+def save_cache(fname, files):
+    '''Write cache atomically'''
+    tmp = fname + '.tmp'
+    try:
+        with open(tmp, 'w', encoding='utf8') as file:
+            json.dump(dict(version=CACHE_VERSION, files=files), file)
+        os.replace(tmp, fname)
+    except OSError as err:
+        print(f'Cache not written: {err}')
+
+
+def scan_versions(path, ignore=ignore_dirs, threads=None, use_cache=True):
+    '''Return {file: version} of path and counts of files read and cached
+
+    version None = not UTF-8, left out in the output.
+    '''
+    cache_fname = os.path.join(path, CACHE_FNAME)
+    cache = load_cache(cache_fname) if use_cache else dict()
+    files, todo = dict(), list()
+    for fname, stat in scan_tree(path, ignore, include_ftypes):
+        if os.path.basename(fname) == CACHE_FNAME:
+            continue
+        key = [stat.st_mtime_ns, stat.st_size]
+        entry = cache.get(fname)
+        if entry and entry[:2] == key:
+            files[fname] = entry
+        else:
+            todo.append((fname, key))
+    if todo:
+        with ThreadPoolExecutor(threads) as pool:
+            vnrs = pool.map(lambda job: check_file(job[0])[0], todo,
+                            chunksize=64)
+            for (fname, key), vnr in zip(todo, vnrs):
+                files[fname] = key + [vnr]
+    if use_cache and (todo or len(files) != len(cache)):
+        save_cache(cache_fname, files)
+    return ({fname: entry[2] for fname, entry in files.items()},
+            len(todo), len(files) - len(todo))
 
 
 if __name__ == '__main__':
-    cwd = os.getcwd()
+    parser = argparse.ArgumentParser(
+        description='Print versions of all source files')
+    parser.add_argument('path', nargs='?', default=os.getcwd(),
+                        help='directory scanned, default current')
+    parser.add_argument('-i', '--ignore', action='append', default=[],
+                        metavar='', help='directory name not entered, '
+                                         'repeat for more')
+    parser.add_argument('-j', '--threads', type=int, metavar='',
+                        help='threads reading files')
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'read all files, do not use {CACHE_FNAME}')
+    args = parser.parse_args()
+    cwd = os.path.abspath(args.path)
+    stime = perf_counter()
+    versions, read, cached = scan_versions(
+        cwd, ignore_dirs.union(args.ignore), args.threads,
+        not args.no_cache)
+    seconds = perf_counter() - stime
     res = defaultdict(list)
-    files = get_allfiles(cwd)
     len_cwd = len(cwd) + 1
-    files = [file for file in files if get_ftype(file) in include_ftypes]
-    for file in files:
-        vnr, ftype = check_file(file)
-        if vnr is None:
-            vnr = 'Missing'
+    for file in sorted(versions):
+        vnr, ftype = versions[file], get_ftype(file)
         if ftype and vnr:
             res[ftype].append((file[len_cwd:], vnr))
     n = 80
@@ -75,3 +199,7 @@ if __name__ == '__main__':
         for fn, vnr in res[key]:
             print(f' {vnr:9s} : {fn}')
     print(f'-'.center(n, '-'))
+    total = read + cached
+    print(f'{total} files in {seconds:.2f} s = '
+          f'{total / max(seconds, 1e-9):.0f} files/s, {read} read, '
+          f'{cached} cached')